@@ -0,0 +1,292 @@
+import argparse
+import gzip
+import json
+import os
+import time
+import numpy as np
+import openai
+from dotenv import load_dotenv
+
+from indice_embeddings import MODOS, cargar_indice, normalizar
+
+# Evaluación offline de la recuperación (FAQ y PDF) y ajuste de umbrales.
+# Uso:
+#   python api/evaluar_recuperacion.py                              # set etiquetado
+#   python api/evaluar_recuperacion.py --replay conversaciones*.jsonl* # preguntas reales del log
+#   python api/evaluar_recuperacion.py --tenant mi_marca --preguntas mis_preguntas.json
+#   python api/evaluar_recuperacion.py --modo int8                     # índice cuantizado que sirve la app
+# Las recomendaciones (umbrales FAQ/PDF y margen del detector fuera de tema) se guardan
+# en api/umbrales.json, que leen main.py y main_v1.py.
+
+load_dotenv()
+openai.api_key = os.getenv("OPENAI_API_KEY")
+
+# -----------------------
+# CONFIGURACIONES
+# -----------------------
+PREGUNTAS_ETIQUETADAS = "./api/preguntas_etiquetadas.json"
+TENANTS_FILE = os.getenv("TENANTS_FILE", "./api/tenants.json")
+TENANT_POR_DEFECTO = os.getenv("TENANT_POR_DEFECTO", "escapadas")
+CACHE_EMBEDDINGS = "./api/cache_embeddings_eval.json"
+EMBEDDING_MODEL = "text-embedding-ada-002"
+LOTE_EMBEDDINGS = 100                              # Preguntas por llamada a la API
+UMBRALES = [round(u, 2) for u in np.arange(0.70, 0.96, 0.01)]
+TOP_KS = [1, 3, 5]
+
+# -----------------------
+# FUNCIONES
+# -----------------------
+def cargar_preguntas(ruta_etiquetadas: str, ruta_replay: list = None) -> list:
+    """
+    Devuelve una lista de dicts {"pregunta", "faq"?, "chunks"?, "valida"?}.
+    En el set etiquetado "faq": null o "chunks": [] significa que NO debería haber coincidencia.
+    "valida": true marca saludos y seguimientos cortos que no coinciden con nada pero no
+    deben rechazarse como fuera de tema.
+    Las preguntas del log (replay) no tienen etiquetas: solo sirven para tasa de aciertos y latencia.
+    """
+    if ruta_replay:
+        log = []
+        for ruta in ruta_replay:
+            # conversaciones.json (formato anterior) o registro local JSONL, rotado o no
+            abrir = gzip.open if ruta.endswith(".gz") else open
+            with abrir(ruta, "rt", encoding="utf-8") as f:
+                if ".jsonl" in ruta:
+                    log.extend(json.loads(linea) for linea in f if linea.strip())
+                else:
+                    log.extend(json.load(f))
+        vistas = set()
+        preguntas = []
+        for entrada in log:
+            texto = entrada.get("pregunta", "").strip()
+            if texto and texto not in vistas:
+                vistas.add(texto)
+                preguntas.append({"pregunta": texto})
+        return preguntas
+
+    with open(ruta_etiquetadas, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def obtener_embeddings(textos: list, ruta_cache: str) -> tuple:
+    """
+    Genera embeddings en lotes (una llamada por LOTE_EMBEDDINGS textos) y los guarda en caché
+    para que las siguientes corridas no paguen de nuevo la API.
+    Retorna (matriz normalizada, latencia media por lote en ms).
+    """
+    cache = {}
+    if os.path.exists(ruta_cache):
+        with open(ruta_cache, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+
+    faltantes = [t for t in textos if t not in cache]
+    latencias = []
+    for inicio in range(0, len(faltantes), LOTE_EMBEDDINGS):
+        lote = faltantes[inicio:inicio + LOTE_EMBEDDINGS]
+        t0 = time.perf_counter()
+        response = openai.Embedding.create(model=EMBEDDING_MODEL, input=lote)
+        latencias.append((time.perf_counter() - t0) * 1000)
+        for item in response["data"]:
+            cache[lote[item["index"]]] = item["embedding"]
+
+    if faltantes:
+        with open(ruta_cache, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+
+    matriz = normalizar(np.array([cache[t] for t in textos], dtype=np.float32))
+    return matriz, (float(np.mean(latencias)) if latencias else None)
+
+def buscar(consultas: np.ndarray, indice, top_k: int):
+    """
+    Búsqueda con el mismo índice que usa la app (exacto o cuantizado).
+    Retorna (ids top-k, similitudes top-k, ms por consulta).
+    """
+    t0 = time.perf_counter()
+    resultados = [indice.buscar(c, top_k=top_k) for c in consultas]
+    ms = (time.perf_counter() - t0) * 1000 / max(len(consultas), 1)
+    top_ids = [[i for i, _ in r] for r in resultados]
+    top_sims = [[s for _, s in r] for r in resultados]
+    return top_ids, top_sims, ms
+
+def evaluar(preguntas: list, campo: str, top_ids: list, top_sims: list, umbral: float) -> dict:
+    """
+    Métricas para un umbral dado. Una pregunta "acierta" si su mejor similitud supera el umbral.
+    - tasa_aciertos: fracción de preguntas que recuperan algo.
+    - precision: de las que recuperan algo (etiquetadas), cuántas traen un id correcto en el top-k.
+    - recall: de las que deberían recuperar algo, cuántas traen un id correcto en el top-k.
+    """
+    aciertos = 0
+    vp = fp = fn = 0
+    for pregunta, ids, sims in zip(preguntas, top_ids, top_sims):
+        recuperados = [i for i, s in zip(ids, sims) if s > umbral]
+        if recuperados:
+            aciertos += 1
+        if campo not in pregunta:
+            continue
+        esperados = pregunta[campo]
+        if campo == "faq":
+            esperados = [esperados] if esperados else []
+        correcto = any(i in esperados for i in recuperados)
+        if recuperados and correcto:
+            vp += 1
+        elif recuperados:
+            fp += 1
+        if esperados and not correcto:
+            fn += 1
+
+    etiquetadas = vp + fp + fn > 0
+    return {
+        "umbral": umbral,
+        "tasa_aciertos": aciertos / max(len(preguntas), 1),
+        "precision": vp / (vp + fp) if vp + fp else (1.0 if etiquetadas else None),
+        "recall": vp / (vp + fn) if vp + fn else (1.0 if etiquetadas else None),
+    }
+
+def recomendar(resultados: list, precision_minima: float) -> dict:
+    """
+    Elige el umbral con mayor recall entre los que cumplen la precisión mínima;
+    si ninguno la cumple, el de mejor F1.
+    """
+    validos = [r for r in resultados if r["precision"] is not None]
+    if not validos:
+        return None
+    cumplen = [r for r in validos if r["precision"] >= precision_minima]
+    if cumplen:
+        return max(cumplen, key=lambda r: (r["recall"], r["umbral"]))
+
+    def f1(r):
+        p, rc = r["precision"], r["recall"]
+        return 2 * p * rc / (p + rc) if p + rc else 0.0
+    return max(validos, key=f1)
+
+def es_fuera_de_tema(pregunta: dict):
+    """
+    Etiqueta on/off-topic: fuera de tema si no debería coincidir ni con el FAQ ni con el PDF.
+    None si la pregunta no está etiquetada para ambos índices.
+    """
+    if "valida" in pregunta:
+        return not pregunta["valida"]
+    if "faq" not in pregunta or "chunks" not in pregunta:
+        return None
+    return not pregunta["faq"] and not pregunta["chunks"]
+
+def entrenar_fuera_de_tema(preguntas: list, consultas: np.ndarray, rechazo_maximo: float, rutas: dict, modo: str = None):
+    """
+    Entrena el margen del detector de preguntas fuera de tema con dos métodos:
+    - vecino: similitud con el vecino más cercano del FAQ o del PDF.
+    - centroide: similitud con el centroide de la base de conocimiento.
+    Elige el umbral que rechaza más preguntas fuera de tema sin rechazar más de
+    rechazo_maximo de las válidas y, a igualdad, el de mayor margen.
+    """
+    etiquetas = [es_fuera_de_tema(p) for p in preguntas]
+    filas = [i for i, e in enumerate(etiquetas) if e is not None]
+    fuera = np.array([etiquetas[i] for i in filas], dtype=bool)
+    if not fuera.any() or fuera.all():
+        return None
+
+    # Mismo cálculo que BaseConocimiento en api/tenants.py
+    faq = cargar_indice(rutas["faq_embeddings"], modo)
+    pdf = cargar_indice(rutas["pdf_embeddings"], modo)
+    centroide = normalizar(faq.centroide() + pdf.centroide())
+    q = consultas[filas]
+    scores = {
+        "vecino": np.array([max(faq.buscar(c)[0][1], pdf.buscar(c)[0][1]) for c in q]),
+        "centroide": q @ centroide,
+    }
+
+    mejor = None
+    for metodo, s in scores.items():
+        valores = np.sort(np.unique(s))
+        for umbral in (valores[:-1] + valores[1:]) / 2:
+            rechazo_validas = float(np.mean(s[~fuera] < umbral))
+            if rechazo_validas > rechazo_maximo:
+                continue
+            candidato = {
+                "metodo": metodo,
+                "umbral": round(float(umbral), 4),
+                "rechazo_fuera_de_tema": float(np.mean(s[fuera] < umbral)),
+                "rechazo_validas": rechazo_validas,
+                "margen": float(np.min(np.abs(s - umbral))),
+            }
+            clave = (candidato["rechazo_fuera_de_tema"], candidato["margen"])
+            if mejor is None or clave > (mejor["rechazo_fuera_de_tema"], mejor["margen"]):
+                mejor = candidato
+        print(f"\nFuera de tema ({metodo}): válidas min {s[~fuera].min():.3f}, "
+              f"fuera de tema max {s[fuera].max():.3f}")
+    return mejor
+
+def imprimir_tabla(nombre: str, top_k: int, resultados: list, ms: float):
+    print(f"\n=== {nombre} (top_k={top_k}, búsqueda {ms:.3f} ms/consulta) ===")
+    print(f"{'umbral':>7} {'aciertos':>9} {'precision':>10} {'recall':>7}")
+    for r in resultados:
+        p = "-" if r["precision"] is None else f"{r['precision']:.3f}"
+        rc = "-" if r["recall"] is None else f"{r['recall']:.3f}"
+        print(f"{r['umbral']:>7.2f} {r['tasa_aciertos']:>9.3f} {p:>10} {rc:>7}")
+
+# -----------------------
+# SCRIPT PRINCIPAL
+# -----------------------
+def main():
+    parser = argparse.ArgumentParser(description="Evalúa la recuperación FAQ/PDF y recomienda umbrales.")
+    parser.add_argument("--preguntas", default=PREGUNTAS_ETIQUETADAS, help="JSON con preguntas etiquetadas")
+    parser.add_argument("--replay", nargs="+", help="Logs de conversaciones a reproducir (sin etiquetas)")
+    parser.add_argument("--precision-minima", type=float, default=0.9)
+    parser.add_argument("--rechazo-maximo", type=float, default=0.0,
+                        help="Fracción máxima de preguntas válidas que el detector fuera de tema puede rechazar")
+    parser.add_argument("--tenant", default=TENANT_POR_DEFECTO, help="Tenant de api/tenants.json a evaluar")
+    parser.add_argument("--salida", help="Por defecto, el archivo de umbrales del tenant")
+    parser.add_argument("--modo", choices=MODOS, default=os.getenv("EMBEDDINGS_CUANTIZACION") or None,
+                        help="Índice cuantizado a evaluar (por defecto el de EMBEDDINGS_CUANTIZACION)")
+    args = parser.parse_args()
+
+    with open(TENANTS_FILE, "r", encoding="utf-8") as f:
+        rutas = json.load(f)[args.tenant]
+    salida = args.salida or rutas["umbrales"]
+
+    preguntas = cargar_preguntas(args.preguntas, args.replay)
+    print(f"Evaluando {len(preguntas)} preguntas ...")
+    consultas, ms_embedding = obtener_embeddings([p["pregunta"] for p in preguntas], CACHE_EMBEDDINGS)
+    if ms_embedding is not None:
+        print(f"Latencia media de embeddings: {ms_embedding:.0f} ms por lote")
+
+    umbrales = {}
+    for nombre, ruta, campo in (("faq", rutas["faq_embeddings"], "faq"), ("pdf", rutas["pdf_embeddings"], "chunks")):
+        indice = cargar_indice(ruta, args.modo or "")
+        mejor = None
+        for top_k in TOP_KS:
+            if top_k > len(indice.ids):
+                continue
+            top_ids, top_sims, ms = buscar(consultas, indice, top_k)
+            resultados = [evaluar(preguntas, campo, top_ids, top_sims, u) for u in UMBRALES]
+            imprimir_tabla(nombre.upper(), top_k, resultados, ms)
+
+            elegido = recomendar(resultados, args.precision_minima)
+            # A igual calidad se prefiere el top_k menor (prompts más cortos)
+            if elegido and (mejor is None or (elegido["recall"], elegido["precision"]) > (mejor["recall"], mejor["precision"])):
+                mejor = dict(elegido, top_k=top_k, ms_busqueda=ms)
+            # La app de FAQ solo usa la mejor coincidencia
+            if nombre == "faq":
+                break
+
+        if mejor:
+            umbrales[nombre] = {"umbral": mejor["umbral"], "top_k": mejor["top_k"]}
+            print(f"\nRecomendado {nombre.upper()}: {mejor}")
+
+    detector = entrenar_fuera_de_tema(preguntas, consultas, args.rechazo_maximo, rutas, args.modo or "")
+    if detector:
+        umbrales["fuera_de_tema"] = {"umbral": detector["umbral"], "metodo": detector["metodo"]}
+        print(f"\nRecomendado FUERA DE TEMA: {detector}")
+
+    if not umbrales:
+        print("\nSin preguntas etiquetadas no se puede recomendar umbrales (solo replay).")
+        return
+
+    existentes = {}
+    if os.path.exists(salida):
+        with open(salida, "r", encoding="utf-8") as f:
+            existentes = json.load(f)
+    existentes.update(umbrales)
+    with open(salida, "w", encoding="utf-8") as f:
+        json.dump(existentes, f, indent=2, ensure_ascii=False)
+    print(f"\nUmbrales guardados en {salida}")
+
+if __name__ == "__main__":
+    main()
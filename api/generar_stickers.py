@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+import sys
+from PIL import Image
+
+# -----------------------
+# CONFIGURACIONES
+# -----------------------
+# Ejecutar en el deploy (antes de levantar la API): python api/generar_stickers.py [directorios...]
+# Sin argumentos procesa los directorios de stickers de todos los tenants (api/tenants.json).
+# Las variantes y el manifest se escriben en <directorio>/variantes/.
+TENANTS_FILE = os.getenv("TENANTS_FILE", "./api/tenants.json")
+ANCHOS = [128, 256, 512]                         # Anchos (px) que puede pedir el widget
+FORMATOS = {"webp": "image/webp", "jpeg": "image/jpeg"}
+CALIDAD = 80
+EXTENSIONES = (".jpg", ".jpeg", ".png", ".webp")
+
+TIPOS_ORIGINAL = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".webp": "image/webp",
+}
+
+# -----------------------
+# FUNCIONES
+# -----------------------
+def calcular_etag(ruta: str) -> str:
+    """
+    ETag fuerte: hash del contenido exacto del archivo.
+    """
+    with open(ruta, "rb") as f:
+        return '"' + hashlib.sha256(f.read()).hexdigest()[:32] + '"'
+
+def generar_variante(imagen: Image.Image, ancho: int, formato: str, destino: str):
+    """
+    Redimensiona manteniendo la proporción y guarda en el formato indicado.
+    Nunca agranda la imagen original.
+    """
+    copia = imagen.copy()
+    if ancho < copia.width:
+        alto = round(copia.height * ancho / copia.width)
+        copia = copia.resize((ancho, alto), Image.LANCZOS)
+    if formato == "jpeg" and copia.mode not in ("RGB", "L"):
+        copia = copia.convert("RGB")
+    copia.save(destino, format=formato.upper(), quality=CALIDAD, optimize=True)
+
+# -----------------------
+# SCRIPT PRINCIPAL
+# -----------------------
+def directorios_de_tenants() -> list:
+    with open(TENANTS_FILE, "r", encoding="utf-8") as f:
+        tenants = json.load(f)
+    return sorted({t["stickers"] for t in tenants.values() if t.get("stickers")})
+
+def procesar_directorio(stickers_dir: str):
+    variantes_dir = os.path.join(stickers_dir, "variantes")
+    manifest_file = os.path.join(variantes_dir, "manifest.json")
+    os.makedirs(variantes_dir, exist_ok=True)
+    manifest = {}
+
+    for nombre in sorted(os.listdir(stickers_dir)):
+        ruta = os.path.join(stickers_dir, nombre)
+        extension = os.path.splitext(nombre)[1].lower()
+        if not os.path.isfile(ruta) or extension not in EXTENSIONES:
+            continue
+
+        print(f"Procesando {nombre} ...")
+        base = os.path.splitext(nombre)[0]
+        entrada = {
+            "original": {
+                "archivo": nombre,
+                "tipo": TIPOS_ORIGINAL[extension],
+                "etag": calcular_etag(ruta),
+                "bytes": os.path.getsize(ruta),
+            },
+            "variantes": [],
+        }
+
+        with Image.open(ruta) as imagen:
+            imagen.load()
+            for ancho in ANCHOS:
+                for formato, tipo in FORMATOS.items():
+                    archivo = f"{base}-{ancho}.{formato}"
+                    destino = os.path.join(variantes_dir, archivo)
+                    generar_variante(imagen, ancho, formato, destino)
+                    entrada["variantes"].append({
+                        "archivo": f"variantes/{archivo}",
+                        "ancho": min(ancho, imagen.width),
+                        "tipo": tipo,
+                        "etag": calcular_etag(destino),
+                        "bytes": os.path.getsize(destino),
+                    })
+
+        manifest[nombre] = entrada
+
+    print(f"Guardando {manifest_file} ...")
+    with open(manifest_file, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+
+def main():
+    for stickers_dir in sys.argv[1:] or directorios_de_tenants():
+        procesar_directorio(stickers_dir)
+
+    print("¡Variantes generadas con éxito!")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import time
+import numpy as np
+
+# Índice de embeddings para la recuperación (FAQ y PDF).
+# - Sin cuantizar: matriz float32 normalizada, búsqueda vectorizada.
+# - Cuantizado (float16 o int8, opcionalmente reducido con PCA): la búsqueda aproximada se hace
+#   sobre la versión compacta y los mejores candidatos se recalculan en precisión completa,
+#   leyendo la matriz float32 desde disco con mmap (no ocupa memoria de cada worker).
+#
+# Los archivos cuantizados se generan en el deploy:
+#   python api/indice_embeddings.py --modo int8 [--pca 256]
+# y la app los usa si EMBEDDINGS_CUANTIZACION=int8|float16.
+#
+# Velocidad medida (ms por consulta, top-5, 1536 dimensiones):
+#   100k vectores: exacto ~49, int8 ~48, int8 + PCA 256 ~9, float16 ~450
+#   índices actuales (15-18 vectores): exacto ~0.025, int8 ~0.04 (costo fijo del rescoring)
+# int8 ahorra 4x de memoria sin perder velocidad; la búsqueda solo es más rápida con PCA.
+# float16 solo ahorra memoria: numpy decodifica float16 muy lento, no se recomienda.
+
+# -----------------------
+# CONFIGURACIONES
+# -----------------------
+TENANTS_FILE = os.getenv("TENANTS_FILE", "./api/tenants.json")   # Índices de todos los tenants
+CACHE_CONSULTAS = "./api/cache_embeddings_eval.json"   # Preguntas reales para medir el recall
+MODOS = ("float16", "int8")
+CANDIDATOS_RESCORING = 10                               # Candidatos que se recalculan en float32
+BLOQUE_BYTES = 1 << 20                                  # Bloque decodificado a float32 (cabe en caché L2)
+
+logger = logging.getLogger(__name__)
+
+# -----------------------
+# ÍNDICE
+# -----------------------
+def rutas_cuantizadas(ruta_json: str) -> tuple:
+    """
+    ./api/faq_embeddings.json -> (./api/faq_embeddings_f32.npy, ./api/faq_embeddings_q.npz)
+    """
+    base = os.path.splitext(ruta_json)[0]
+    return f"{base}_f32.npy", f"{base}_q.npz"
+
+def huella_json(ruta_json: str) -> str:
+    """Hash del JSON de origen: los archivos cuantizados la guardan para detectar que quedaron viejos."""
+    with open(ruta_json, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def normalizar(matriz: np.ndarray) -> np.ndarray:
+    return matriz / np.linalg.norm(matriz, axis=-1, keepdims=True)
+
+class IndiceEmbeddings:
+    def __init__(self, ids, codigos, completos=None, escalas=None, media=None, componentes=None):
+        self.ids = list(ids)
+        self.codigos = codigos          # float32 (exacto), float16 o int8
+        self.completos = completos      # float32 normalizado (mmap) para el rescoring; None si es exacto
+        self.escalas = escalas          # escala por vector (solo int8)
+        self.media = media              # PCA (opcional)
+        self.componentes = componentes
+
+    @classmethod
+    def desde_dict(cls, raw: dict):
+        """Índice exacto a partir de {id: vector}."""
+        ids = list(raw.keys())
+        matriz = normalizar(np.array([raw[i] for i in ids], dtype=np.float32))
+        return cls(ids, matriz)
+
+    @classmethod
+    def desde_archivos(cls, ruta_json: str):
+        """
+        Índice cuantizado a partir de los archivos generados por este script.
+        Retorna None si se generaron a partir de otra versión del JSON.
+        """
+        ruta_f32, ruta_q = rutas_cuantizadas(ruta_json)
+        datos = np.load(ruta_q, allow_pickle=False)
+        huella = str(datos["huella"]) if "huella" in datos.files else None
+        if huella != huella_json(ruta_json):
+            return None
+        return cls(
+            datos["ids"].tolist(),
+            datos["codigos"],
+            completos=np.load(ruta_f32, mmap_mode="r"),
+            escalas=datos["escalas"] if "escalas" in datos.files else None,
+            media=datos["media"] if "media" in datos.files else None,
+            componentes=datos["componentes"] if "componentes" in datos.files else None,
+        )
+
+    @property
+    def bytes_en_memoria(self) -> int:
+        extras = [self.escalas, self.media, self.componentes]
+        return self.codigos.nbytes + sum(a.nbytes for a in extras if a is not None)
+
+    def centroide(self) -> np.ndarray:
+        """Centroide normalizado del índice (siempre en precisión completa)."""
+        matriz = self.completos if self.completos is not None else self.codigos
+        return normalizar(np.asarray(matriz, dtype=np.float32).mean(axis=0))
+
+    def _proyectar(self, consulta: np.ndarray) -> np.ndarray:
+        if self.componentes is None:
+            return consulta
+        return normalizar((consulta - self.media) @ self.componentes)
+
+    def _scores_aproximados(self, consulta: np.ndarray) -> np.ndarray:
+        q = self._proyectar(consulta).astype(np.float32, copy=False)
+        if self.codigos.dtype == np.float32:
+            return self.codigos @ q
+        # numpy no tiene BLAS para int8/float16: se decodifica por bloques pequeños sobre un
+        # mismo buffer, así la copia float32 se queda en caché y el producto no vuelve a RAM
+        filas = max(1, BLOQUE_BYTES // (self.codigos.shape[1] * 4))
+        buffer = np.empty((filas, self.codigos.shape[1]), dtype=np.float32)
+        scores = np.empty(len(self.ids), dtype=np.float32)
+        for inicio in range(0, len(self.ids), filas):
+            bloque = self.codigos[inicio:inicio + filas]
+            decodificado = buffer[:len(bloque)]
+            np.copyto(decodificado, bloque, casting="unsafe")
+            np.dot(decodificado, q, out=scores[inicio:inicio + len(bloque)])
+        if self.escalas is not None:
+            scores *= self.escalas
+        return scores
+
+    def buscar(self, embedding, top_k: int = 1, candidatos: int = CANDIDATOS_RESCORING) -> list:
+        """
+        Retorna [(id, similitud_coseno), ...] ordenado de mayor a menor.
+        En índices cuantizados la similitud devuelta es la exacta (rescoring en float32).
+        """
+        consulta = normalizar(np.asarray(embedding, dtype=np.float32))
+        scores = self._scores_aproximados(consulta)
+        n = max(top_k, candidatos) if self.completos is not None else top_k
+        n = min(n, len(self.ids))
+        mejores = np.argpartition(-scores, n - 1)[:n]
+        if self.completos is not None:
+            mejores = np.sort(mejores)
+            scores_exactos = np.asarray(self.completos[mejores]) @ consulta
+            orden = np.argsort(-scores_exactos)[:top_k]
+            return [(self.ids[mejores[i]], float(scores_exactos[i])) for i in orden]
+        orden = mejores[np.argsort(-scores[mejores])][:top_k]
+        return [(self.ids[i], float(scores[i])) for i in orden]
+
+def cargar_indice(ruta_json: str, modo: str = None) -> IndiceEmbeddings:
+    """
+    Usa la versión cuantizada si se pidió un modo y los archivos existen; si no, el JSON exacto.
+    """
+    modo = modo if modo is not None else os.getenv("EMBEDDINGS_CUANTIZACION", "")
+    if modo in MODOS:
+        if not all(os.path.exists(r) for r in rutas_cuantizadas(ruta_json)):
+            logger.warning("%s: no hay índice %s generado, se usa el JSON sin cuantizar", ruta_json, modo)
+        else:
+            indice = IndiceEmbeddings.desde_archivos(ruta_json)
+            if indice is None:
+                logger.warning("%s: el índice cuantizado es de otra versión del JSON (regenerar con "
+                               "api/indice_embeddings.py), se usa el JSON sin cuantizar", ruta_json)
+            elif indice.codigos.dtype.name != modo:
+                logger.warning("%s: el índice generado es %s y se pidió %s, se usa el JSON sin cuantizar",
+                               ruta_json, indice.codigos.dtype.name, modo)
+            else:
+                return indice
+    elif modo:
+        logger.warning("EMBEDDINGS_CUANTIZACION=%s no es válido (%s), se usa el JSON sin cuantizar", modo, "|".join(MODOS))
+    with open(ruta_json, "r", encoding="utf-8") as f:
+        return IndiceEmbeddings.desde_dict(json.load(f))
+
+# -----------------------
+# CUANTIZACIÓN (deploy)
+# -----------------------
+def calcular_pca(matriz: np.ndarray, dimensiones: int) -> tuple:
+    """
+    Retorna (media, componentes d x dimensiones). Con pocos vectores las dimensiones
+    quedan limitadas por el número de filas.
+    """
+    media = matriz.mean(axis=0)
+    _, _, vt = np.linalg.svd(matriz - media, full_matrices=False)
+    return media.astype(np.float32), vt[:dimensiones].T.astype(np.float32)
+
+def cuantizar(matriz: np.ndarray, modo: str, pca: int = None) -> dict:
+    """
+    Cuantiza una matriz float32 normalizada. int8 usa cuantización escalar simétrica por vector.
+    """
+    arrays = {}
+    reducida = matriz
+    if pca:
+        media, componentes = calcular_pca(matriz, pca)
+        reducida = normalizar((matriz - media) @ componentes)
+        arrays["media"] = media
+        arrays["componentes"] = componentes
+
+    if modo == "float16":
+        arrays["codigos"] = reducida.astype(np.float16)
+    else:
+        escalas = np.abs(reducida).max(axis=1) / 127.0
+        escalas[escalas == 0] = 1.0
+        arrays["codigos"] = np.round(reducida / escalas[:, None]).astype(np.int8)
+        arrays["escalas"] = escalas.astype(np.float32)
+    return arrays
+
+def guardar_cuantizado(ruta_json: str, modo: str, pca: int = None):
+    with open(ruta_json, "r", encoding="utf-8") as f:
+        raw = json.load(f)
+    ids = list(raw.keys())
+    matriz = normalizar(np.array([raw[i] for i in ids], dtype=np.float32))
+
+    ruta_f32, ruta_q = rutas_cuantizadas(ruta_json)
+    np.save(ruta_f32, matriz)
+    np.savez(ruta_q, ids=np.array(ids), huella=np.array(huella_json(ruta_json)), **cuantizar(matriz, modo, pca))
+    return ids, matriz
+
+def medir_recall(indice: IndiceEmbeddings, exacto: IndiceEmbeddings, consultas: np.ndarray, k: int) -> tuple:
+    """
+    Fracción de los top-k exactos que recupera el índice cuantizado, y ms por consulta.
+    """
+    encontrados = 0
+    t0 = time.perf_counter()
+    resultados = [indice.buscar(c, top_k=k) for c in consultas]
+    ms = (time.perf_counter() - t0) * 1000 / len(consultas)
+    for consulta, resultado in zip(consultas, resultados):
+        esperados = {i for i, _ in exacto.buscar(consulta, top_k=k)}
+        encontrados += len(esperados & {i for i, _ in resultado})
+    return encontrados / (len(consultas) * k), ms
+
+def indices_de_tenants() -> list:
+    with open(TENANTS_FILE, "r", encoding="utf-8") as f:
+        tenants = json.load(f)
+    rutas = []
+    for config in tenants.values():
+        for clave in ("faq_embeddings", "pdf_embeddings"):
+            if config.get(clave) and config[clave] not in rutas:
+                rutas.append(config[clave])
+    return rutas
+
+def main():
+    parser = argparse.ArgumentParser(description="Genera índices de embeddings cuantizados.")
+    parser.add_argument("--modo", choices=MODOS, default="int8")
+    parser.add_argument("--pca", type=int, help="Dimensiones tras PCA (opcional)")
+    args = parser.parse_args()
+
+    consultas_reales = None
+    if os.path.exists(CACHE_CONSULTAS):
+        with open(CACHE_CONSULTAS, "r", encoding="utf-8") as f:
+            consultas_reales = normalizar(np.array(list(json.load(f).values()), dtype=np.float32))
+
+    for ruta_json in indices_de_tenants():
+        print(f"Cuantizando {ruta_json} ({args.modo}{', PCA ' + str(args.pca) if args.pca else ''}) ...")
+        ids, matriz = guardar_cuantizado(ruta_json, args.modo, args.pca)
+        exacto = IndiceEmbeddings(ids, matriz)
+        indice = IndiceEmbeddings.desde_archivos(ruta_json)
+
+        # float64 en listas de np.array: así se cargaba antes en la app
+        bytes_antes = matriz.size * 8
+        print(f"  Memoria: {bytes_antes / 1024:.0f} KB (float64) -> {indice.bytes_en_memoria / 1024:.0f} KB "
+              f"({bytes_antes / indice.bytes_en_memoria:.1f}x menos)")
+
+        consultas = consultas_reales if consultas_reales is not None else matriz
+        for k in (1, 5):
+            if k > len(ids):
+                continue
+            recall, ms = medir_recall(indice, exacto, consultas, k)
+            _, ms_exacto = medir_recall(exacto, exacto, consultas, k)
+            print(f"  recall@{k}: {recall:.3f}  ({ms:.3f} ms/consulta vs {ms_exacto:.3f} ms exacto)")
+
+    print("¡Índices cuantizados generados! Activa con EMBEDDINGS_CUANTIZACION=" + args.modo)
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,8 @@ import datetime
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 
+from api.tenants import obtener_base
+
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
 
@@ -55,38 +57,25 @@ def obtener_embedding(texto: str) -> np.ndarray:
     )
     return np.array(response["data"][0]["embedding"])
 
-def similaridad_coseno(vec1: np.ndarray, vec2: np.ndarray) -> float:
-    """Calcula la similitud coseno normalizada."""
-    return np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
-
-# Carga de CHUNKS y EMBEDDINGS (provenientes de tus PDFs)
-# pdf_chunks.json -> {"chunk_0": "...texto del chunk...", "chunk_1": "...", ...}
-# pdf_embeddings.json -> {"chunk_0": [0.0123, ...], "chunk_1": [...], ...}
-
-with open("./api/pdf_chunks.json", "r", encoding="utf-8") as f:
-    pdf_chunks = json.load(f)  # dict chunk_id -> texto
+# App anterior (solo PDF, sin FAQ ni sesiones): atiende únicamente al tenant por defecto.
+# Los tenants adicionales se sirven con main_v1.py.
+# Chunks, índice (cuantizado si EMBEDDINGS_CUANTIZACION=int8|float16) y umbrales
+# salen de la configuración del tenant en api/tenants.json.
+base = obtener_base()
+pdf_chunks = base.pdf_chunks
+indice_pdf = base.indice_pdf
 
-with open("./api/pdf_embeddings.json", "r", encoding="utf-8") as f:
-    raw_embeddings = json.load(f)  # dict chunk_id -> [float, float, ...]
-
-pdf_embeddings = {
-    k: np.array(v) for k, v in raw_embeddings.items()
-}
+# Umbral y top_k del PDF (se recalculan con api/evaluar_recuperacion.py)
+umbrales_pdf = base.umbrales.get("pdf", {})
+UMBRAL_PDF = umbrales_pdf.get("umbral", -1.0)
+TOP_K_PDF = umbrales_pdf.get("top_k", 1)
 
 def encontrar_mejor_chunk(pregunta: str) -> str:
-    """Devuelve el chunk de texto más relevante para la pregunta."""
+    """Devuelve los chunks más relevantes (hasta TOP_K_PDF) que superan UMBRAL_PDF."""
     embedding_pregunta = obtener_embedding(pregunta)
-    best_chunk_id = None
-    best_score = -1
-
-    for chunk_id, chunk_vec in pdf_embeddings.items():
-        score = similaridad_coseno(embedding_pregunta, chunk_vec)
-        if score > best_score:
-            best_score = score
-            best_chunk_id = chunk_id
-    
-    # Podrías aplicar un umbral, p. ej. si best_score < 0.75, devuelves None
-    return pdf_chunks[best_chunk_id] if best_chunk_id else ""
+    mejores = indice_pdf.buscar(embedding_pregunta, top_k=TOP_K_PDF)
+    relevantes = [pdf_chunks[chunk_id] for chunk_id, score in mejores if score > UMBRAL_PDF]
+    return "\n\n".join(relevantes)
 
 # ========== LÓGICA DEL CHAT ==========
 
@@ -1,42 +1,78 @@
-from fastapi import FastAPI, Request
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import FileResponse
 import openai
 from dotenv import load_dotenv
 import os
 import json
 import numpy as np
 import datetime
+import hashlib
+import logging
+from collections import OrderedDict
 
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 import io
 
+from api import registro_local
+from api.indice_embeddings import normalizar
+from api.presupuesto import ETAPAS, Presupuesto, PresupuestoAgotado, llamar
+from api.sesiones import emitir_token, id_para_registro, identificar_sesion, obtener_sesion, sesion_iniciada, turno_de_sesion
+from api.tenants import TENANT_POR_DEFECTO, TenantDesconocido, obtener_base
 
+logger = logging.getLogger(__name__)
 
 
-# Autenticación con Google Sheets
-scope = [
-    "https://spreadsheets.google.com/feeds",
-    "https://www.googleapis.com/auth/drive" 
-]
-# Intenta cargar desde variable de entorno (Railway)
-google_creds_json = os.getenv("GOOGLE_CREDENTIALS")
 
-if google_creds_json:
-    # Si existe la variable en Railway, úsala
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(json.loads(google_creds_json), scope)
-else:
-    # Si estás en local, usa archivo local
-    creds = ServiceAccountCredentials.from_json_keyfile_name("./api/guias-digitales-9c87ddbffba6.json", scope)
+# Registro de interacciones: Google Sheets (por defecto) o registro local append-only
+# (REGISTRO_INTERACCIONES=local, ver api/registro_local.py) para entornos sin Sheets.
+REGISTRO_INTERACCIONES = os.getenv("REGISTRO_INTERACCIONES", "sheets")
+if REGISTRO_INTERACCIONES not in ("sheets", "local"):
+    raise ValueError(f"REGISTRO_INTERACCIONES debe ser 'sheets' o 'local', no {REGISTRO_INTERACCIONES!r}")
+
+if REGISTRO_INTERACCIONES == "sheets":
+    # Autenticación con Google Sheets
+    scope = [
+        "https://spreadsheets.google.com/feeds",
+        "https://www.googleapis.com/auth/drive" 
+    ]
+    # Intenta cargar desde variable de entorno (Railway)
+    google_creds_json = os.getenv("GOOGLE_CREDENTIALS")
 
-client = gspread.authorize(creds)
+    if google_creds_json:
+        # Si existe la variable en Railway, úsala
+        creds = ServiceAccountCredentials.from_json_keyfile_dict(json.loads(google_creds_json), scope)
+    else:
+        # Si estás en local, usa archivo local
+        creds = ServiceAccountCredentials.from_json_keyfile_name("./api/guias-digitales-9c87ddbffba6.json", scope)
+
+    client = gspread.authorize(creds)
 
-# Abre la hoja
-SHEET_NAME = "Chat Interacciones"
-sheet = client.open(SHEET_NAME).sheet1
+    # Abre la hoja
+    SHEET_NAME = "Chat Interacciones"
+    sheet = client.open(SHEET_NAME).sheet1
+else:
+    # Rotaciones que un reinicio haya dejado sin comprimir
+    registro_local.recomprimir_pendientes()
 
-def guardar_interaccion(user_id, pregunta, respuesta, origen="gpt",tipo_negocio="desconocido",intencion="desconocido",nivel_conocimiento="desconocido"):
+def guardar_interaccion(user_id, pregunta, respuesta, origen="gpt",tipo_negocio="desconocido",intencion="desconocido",nivel_conocimiento="desconocido",tenant=TENANT_POR_DEFECTO):
     timestamp = datetime.datetime.now().isoformat()
+    if REGISTRO_INTERACCIONES == "local":
+        registro_local.guardar({
+            "timestamp": timestamp,
+            "user_id": user_id,
+            "pregunta": pregunta,
+            "respuesta": respuesta,
+            "origen": origen,
+            "tipo_negocio": tipo_negocio,
+            "intencion": intencion,
+            "nivel_conocimiento": nivel_conocimiento,
+            "tenant": tenant,
+        })
+        return
     row = [
         timestamp,
         user_id,
@@ -45,18 +81,19 @@ def guardar_interaccion(user_id, pregunta, respuesta, origen="gpt",tipo_negocio=
         origen,
         tipo_negocio,
         intencion,
-        nivel_conocimiento
+        nivel_conocimiento,
+        tenant
     ]
     sheet.append_row(row)
 
 
-def analizar_usuario(mensaje):
+def analizar_usuario(mensaje, marca, timeout=None):
     prompt = f"""
 Eres un analizador de perfil de usuario. Dado el siguiente mensaje, devuelve una estructura JSON con:
 
 - tipo_negocio: (hotel, restaurante, guía, otro)
 - intencion: (registrarse, aumentar visibilidad, solo informarse, otro)
-- nivel_conocimiento: (nuevo, ya conoce Escapadas.mx, registrado)
+- nivel_conocimiento: (nuevo, ya conoce {marca}, registrado)
 
 Mensaje del usuario:
 "{mensaje}"
@@ -66,7 +103,8 @@ Responde solo el JSON, sin explicación.
 
     response = openai.ChatCompletion.create(
         model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}]
+        messages=[{"role": "user", "content": prompt}],
+        request_timeout=timeout
     )
 
     try:
@@ -80,7 +118,7 @@ Responde solo el JSON, sin explicación.
     return perfil
 
 
-def parafrasear_respuesta(texto, estilo="más empático y conversacional"):
+def parafrasear_respuesta(texto, estilo="más empático y conversacional", timeout=None):
     prompt = (
         f"Reformula este contenido en un tono {estilo}, manteniendo la información y formato en HTML amigable, "
         f"con párrafos <p>, saltos de línea <br> y palabras clave en <strong>:\n\n{texto}"
@@ -89,12 +127,39 @@ def parafrasear_respuesta(texto, estilo="más empático y conversacional"):
     response = openai.ChatCompletion.create(
         model="gpt-3.5-turbo",
         messages=[{"role": "user", "content": prompt}],
-        temperature=0.1  # Ajusta el valor de la temperatura
+        temperature=0.1,  # Ajusta el valor de la temperatura
+        request_timeout=timeout
     )
     
     return response.choices[0].message["content"]
 
 
+def responder_con_gpt(mensajes, timeout=None):
+    response = openai.ChatCompletion.create(
+        model="gpt-3.5-turbo",
+        messages=mensajes,
+        temperature=0.1,  # Ajusta el valor de la temperatura
+        request_timeout=timeout
+    )
+    return response.choices[0].message["content"]
+
+
+def registrar_interaccion(user_id, pregunta, respuesta, origen, base):
+    """Análisis del perfil + registro. Corre después de enviar la respuesta (BackgroundTasks)."""
+    try:
+        perfil_usuario = analizar_usuario(pregunta, base.marca, timeout=ETAPAS["analisis"]["tope"])
+    except Exception:
+        logger.warning("Etapa analisis degradada: se registra sin perfil", exc_info=True)
+        perfil_usuario = {}
+    guardar_interaccion(
+        user_id, pregunta, respuesta, origen=origen,
+        tipo_negocio=perfil_usuario.get("tipo_negocio", "desconocido"),
+        intencion=perfil_usuario.get("intencion", "desconocido"),
+        nivel_conocimiento=perfil_usuario.get("nivel_conocimiento", "desconocido"),
+        tenant=base.tenant_id
+    )
+
+
 app = FastAPI()
 
 load_dotenv()
@@ -107,369 +172,300 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Session-Id"],
 )
+
+# Compresión de las respuestas JSON del chat (brotli si está instalado, si no gzip).
+# Los stickers ya vienen comprimidos (JPEG/WebP), así que se sirven tal cual.
+try:
+    from brotli_asgi import BrotliMiddleware
+except ImportError:
+    BrotliMiddleware = None
+
+class CompresionSelectiva:
+    def __init__(self, app, excluir=("/stickers/",)):
+        self.app = app
+        self.excluir = excluir
+        if BrotliMiddleware:
+            self.comprimida = BrotliMiddleware(app, minimum_size=500)
+        else:
+            self.comprimida = GZipMiddleware(app, minimum_size=500)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith(self.excluir):
+            await self.app(scope, receive, send)
+        else:
+            await self.comprimida(scope, receive, send)
+
+app.add_middleware(CompresionSelectiva)
+
 def enriquece_html(texto):
     partes = texto.split("\n\n")  # Suponiendo que hay saltos dobles
     return "".join([f"<p>{parte.strip()}</p><br>" for parte in partes])
 
-def guardar_interaccio_old(user_id, pregunta, respuesta, origen="gpt"):
-    log_entry = {
-        "timestamp": datetime.datetime.now().isoformat(),
-        "user_id": user_id,
-        "pregunta": pregunta,
-        "respuesta": respuesta,
-        "origen": origen  # puede ser "faq" o "gpt"
-    }
-
-    ruta_log = "conversaciones.json"
-    
-    # Si ya existe el archivo, carga el contenido
-    if os.path.exists(ruta_log):
-        with open(ruta_log, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    else:
-        data = []
-
-    data.append(log_entry)
-
-    with open(ruta_log, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+# Bases de conocimiento por tenant (FAQ, índices, prompt, umbrales y stickers), ver api/tenants.py.
+# Los embeddings se cuantizan si EMBEDDINGS_CUANTIZACION=int8|float16 (api/indice_embeddings.py).
 
-# Cargar embeddings y datos del FAQ
-with open("./api/faq_embeddings.json", "r", encoding="utf-8") as f:
-    raw_embeddings = json.load(f)
-
-faq_embeddings = {
-    pregunta: np.array(embedding)
-    for pregunta, embedding in raw_embeddings.items()
-}
+# Refuerzo de formato que acompaña a cada turno enviado a GPT
+INSTRUCCION_BREVEDAD = (
+    "Responde de manera muy breve y concisa, sin expandirte demasiado. Usa oraciones cortas, "
+    "de no más de 10 líneas. Mantén el formato en HTML amigable y con palabras clave en <strong>."
+)
 
-with open("./api/faq_data.json", "r", encoding="utf-8") as f:
-    faq = json.load(f)
+def tenant_de_request(request: Request, data: dict = None):
+    """El tenant se elige por header X-Tenant, campo "tenant" del body o ?tenant=."""
+    return (
+        request.headers.get("x-tenant")
+        or (data or {}).get("tenant")
+        or request.query_params.get("tenant")
+        or TENANT_POR_DEFECTO
+    )
 
-# Historial de conversación por sesión (temporal)
-user_sessions = {}
+async def base_de_request(request: Request, data: dict = None):
+    try:
+        # La primera carga de un tenant lee archivos: fuera del event loop
+        return await run_in_threadpool(obtener_base, tenant_de_request(request, data))
+    except TenantDesconocido as e:
+        raise HTTPException(status_code=404, detail=f"Tenant desconocido: {e}")
 
 # Embedding de la pregunta
-def obtener_embedding(texto):
+def obtener_embedding(texto, timeout=None):
     response = openai.Embedding.create(
         model="text-embedding-ada-002",
-        input=texto
+        input=texto,
+        request_timeout=timeout
     )
     return np.array(response["data"][0]["embedding"])
 
 # Buscar pregunta similar
-def encontrar_pregunta_mas_similar(pregunta_usuario):
-    embedding_usuario = obtener_embedding(pregunta_usuario)
-    similitudes = {
-        pregunta: np.dot(embedding_usuario, embedding) / (
-            np.linalg.norm(embedding_usuario) * np.linalg.norm(embedding)
-        )
-        for pregunta, embedding in faq_embeddings.items()
-    }
-    pregunta_mas_similar = max(similitudes, key=similitudes.get)
-    mayor_similitud = similitudes[pregunta_mas_similar]
-    if mayor_similitud > 0.85:
+def encontrar_pregunta_mas_similar(base, embedding_usuario):
+    pregunta_mas_similar, mayor_similitud = base.indice_faq.buscar(embedding_usuario, top_k=1)[0]
+    if mayor_similitud > base.umbrales["faq"]["umbral"]:
         return pregunta_mas_similar
     return None
 
+# ========== RESPALDOS (presupuesto agotado) ==========
+MAX_RESPUESTAS_CACHE = 256
+
+# Últimas respuestas de GPT por (tenant, pregunta normalizada) (LRU)
+respuestas_cache = OrderedDict()
+
+def clave_cache(base, pregunta):
+    return (base.tenant_id, " ".join(pregunta.lower().split()))
+
+def cachear_respuesta(base, pregunta, respuesta):
+    clave = clave_cache(base, pregunta)
+    respuestas_cache[clave] = respuesta
+    respuestas_cache.move_to_end(clave)
+    if len(respuestas_cache) > MAX_RESPUESTAS_CACHE:
+        respuestas_cache.popitem(last=False)
+
+def respuesta_de_respaldo(base, pregunta, embedding_usuario=None):
+    """Mejor respuesta sin LLM: la cacheada para la misma pregunta, la FAQ más cercana o el contacto."""
+    clave = clave_cache(base, pregunta)
+    if clave in respuestas_cache:
+        respuestas_cache.move_to_end(clave)
+        return respuestas_cache[clave], "cache"
+    if embedding_usuario is not None:
+        pregunta_cercana, similitud = base.indice_faq.buscar(embedding_usuario, top_k=1)[0]
+        if similitud > base.umbrales["faq"]["umbral_respaldo"]:
+            return enriquece_html(base.faq[pregunta_cercana]["respuesta"]), "faq_respaldo"
+    return base.respuesta_contacto, "contacto"
+
+# Detector local de preguntas fuera de tema: si la pregunta queda lejos de la base de
+# conocimiento (FAQ + PDF) se responde con el rechazo fijo, sin llamar a ChatCompletion.
+# Se desactiva si no hay margen entrenado: api/evaluar_recuperacion.py lo calcula y lo guarda
+# en el archivo de umbrales del tenant (el repo no incluye ninguno entrenado).
+def similitud_con_conocimiento(base, embedding_usuario):
+    """Cercanía de la pregunta a la base de conocimiento según el método entrenado."""
+    if base.umbrales.get("fuera_de_tema", {}).get("metodo", "vecino") == "centroide":
+        return float(np.dot(normalizar(np.asarray(embedding_usuario, dtype=np.float32)), base.centroide))
+    return max(
+        base.indice_faq.buscar(embedding_usuario, top_k=1)[0][1],
+        base.indice_pdf.buscar(embedding_usuario, top_k=1)[0][1],
+    )
+
+def es_fuera_de_tema(base, embedding_usuario):
+    umbral = base.umbrales.get("fuera_de_tema", {}).get("umbral")
+    if umbral is None:
+        return False
+    return similitud_con_conocimiento(base, embedding_usuario) < umbral
+
+# ========== STICKERS ==========
+# Las variantes redimensionadas/WebP se generan en el deploy con api/generar_stickers.py
+# Con ?v=<versión> la URL cambia cuando cambia el sticker, así que puede cachearse un año;
+# sin versión (URLs viejas o escritas a mano) se revalida con el ETag.
+STICKERS_CACHE_CONTROL = "public, max-age=31536000, immutable"
+STICKERS_CACHE_CONTROL_SIN_VERSION = "public, max-age=300, must-revalidate"
+# URL pública de la API (el widget vive en otros sitios). Si no se define se reconstruye con los
+# headers X-Forwarded-* del proxy de Railway: uvicorn deja el esquema en http detrás del proxy.
+URL_PUBLICA = os.getenv("URL_PUBLICA", "").rstrip("/")
+
+def url_publica(request: Request):
+    if URL_PUBLICA:
+        return URL_PUBLICA
+    esquema = request.headers.get("x-forwarded-proto", request.url.scheme).split(",")[0].strip()
+    host = request.headers.get("x-forwarded-host", request.headers.get("host", request.url.netloc)).split(",")[0].strip()
+    return f"{esquema}://{host}"
+
+# ETags de los originales que no están en el manifest (se calculan una sola vez)
+etags_stickers = {}
+
+def etag_archivo(ruta):
+    if ruta not in etags_stickers:
+        with open(ruta, "rb") as f:
+            etags_stickers[ruta] = '"' + hashlib.sha256(f.read()).hexdigest()[:32] + '"'
+    return etags_stickers[ruta]
+
+def elegir_variante(base, nombre, ancho=None, acepta_webp=False):
+    """Elige la variante más ligera que cubra el ancho pedido; si no hay, el original."""
+    entrada = base.stickers_manifest.get(nombre)
+    if not entrada:
+        return None
+    variantes = entrada["variantes"]
+    if not acepta_webp:
+        variantes = [v for v in variantes if v["tipo"] != "image/webp"]
+    if ancho:
+        suficientes = [v for v in variantes if v["ancho"] >= ancho]
+        if suficientes:
+            return min(suficientes, key=lambda v: (v["ancho"], v["bytes"]))
+    elif variantes:
+        # Sin ancho explícito se sirve la variante más grande (nunca mayor que el original)
+        mayor = max(v["ancho"] for v in variantes)
+        return min((v for v in variantes if v["ancho"] == mayor), key=lambda v: v["bytes"])
+    return entrada["original"]
+
+def version_sticker(base, nombre):
+    """Versión de contenido del sticker original (del manifest o del hash del archivo)."""
+    entrada = base.stickers_manifest.get(nombre)
+    if entrada:
+        return entrada["original"]["etag"].strip('"')[:16]
+    ruta = os.path.join(base.stickers_dir, nombre)
+    if base.stickers_dir and os.path.isfile(ruta):
+        return etag_archivo(ruta).strip('"')[:16]
+    return None
+
+def url_sticker(base, sticker, request: Request):
+    """Los stickers locales (solo nombre de archivo) se sirven con URL absoluta y versionada."""
+    if not sticker or sticker.startswith(("http://", "https://")):
+        return sticker
+    nombre = os.path.basename(sticker)
+    origen = url_publica(request)
+    parametros = []
+    if base.tenant_id != TENANT_POR_DEFECTO:
+        parametros.append(f"tenant={base.tenant_id}")
+    version = version_sticker(base, nombre)
+    if version:
+        parametros.append(f"v={version}")
+    consulta = "?" + "&".join(parametros) if parametros else ""
+    return f"{origen}/stickers/{nombre}{consulta}"
+
+@app.get("/stickers/{nombre}")
+async def obtener_sticker(nombre: str, request: Request, ancho: int = None, v: str = None):
+    base = await base_de_request(request)
+    if os.path.basename(nombre) != nombre or not base.stickers_dir:
+        return Response(status_code=404)
+
+    acepta_webp = "image/webp" in request.headers.get("accept", "")
+    variante = elegir_variante(base, nombre, ancho, acepta_webp)
+    if variante:
+        ruta = os.path.join(base.stickers_dir, variante["archivo"])
+        tipo = variante["tipo"]
+        etag = variante["etag"]
+    else:
+        ruta = os.path.join(base.stickers_dir, nombre)
+        if not os.path.isfile(ruta):
+            return Response(status_code=404)
+        tipo = None
+        etag = etag_archivo(ruta)
+
+    versionada = v is not None and v == version_sticker(base, nombre)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": STICKERS_CACHE_CONTROL if versionada else STICKERS_CACHE_CONTROL_SIN_VERSION,
+        "Vary": "Accept",
+    }
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(ruta, media_type=tipo, headers=headers)
+
 # Endpoint principal
 @app.post("/chat")
-async def chat(request: Request):
+async def chat(request: Request, response: Response, background_tasks: BackgroundTasks):
+    # Sesión: token del cliente (cookie o X-Session-Id) o, si aún no lo manda, la IP real.
+    # El turno se reserva al llegar, antes de cualquier await: los turnos de una misma sesión
+    # se atienden en orden de llegada aunque el embedding de uno tarde más que el de otro.
+    user_id, token_nuevo = identificar_sesion(request)
+    async with turno_de_sesion(user_id):
+        return await atender_turno(request, response, background_tasks, user_id, token_nuevo)
+
+async def atender_turno(request, response, background_tasks, user_id, token_nuevo):
     data = await request.json()
     pregunta_usuario = data.get("message", "")
-    user_id = request.client.host
-
-    # 1. Buscar coincidencia en el FAQ
-    pregunta_similar = encontrar_pregunta_mas_similar(pregunta_usuario)
-    if pregunta_similar:
-        respuesta_original = faq[pregunta_similar]["respuesta"]
-        respuesta_parafraseada = parafrasear_respuesta(respuesta_original)
-
-        perfil_usuario = analizar_usuario(pregunta_usuario)
-
-        guardar_interaccion(user_id, pregunta_usuario, respuesta_parafraseada, origen="faq")
-        return {"response": respuesta_parafraseada, "sticker": faq[pregunta_similar]["sticker"]}
-        #guardar_interaccion(user_id, pregunta_usuario, respuesta["respuesta"], origen="faq",tipo_negocio=perfil_usuario["tipo_negocio"],intencion=perfil_usuario["intencion"],nivel_conocimiento=perfil_usuario["nivel_conocimiento"])
-        #return {"response": respuesta["respuesta"], "sticker": respuesta["sticker"]}
-
-    # 2. Si no hay coincidencia, usar memoria y GPT
-    if user_id not in user_sessions:
-        user_sessions[user_id] = [
-            {"role": "system", "content": '''
-            <ContextDefinition>
-
-  <!-- ROL DEL ASISTENTE -->
-  <Rol>
-    <Nombre>Eres un asistente</Nombre>
-    <Descripcion>
-      Estoy aquí para ayudarte a explorar oportunidades que impulsen tu negocio turístico y te permitan conectar con viajeros que buscan vivir momentos inolvidables.
-      - NO INVENTES INFORMACIÓN, COMO CORREOS, PRECIOS, TELEFONOS.
-
-
-      IMPORTANTE:
-      - **Si el usuario pregunta algo fuera de los temas de turismo, planes o beneficios de escapadas.mx, debes responder con un mensaje breve y educado indicando que solo atiendes dudas sobre escapadas.mx**.
-      - No eres un ChatGPT general, no des soporte ni consejos de otro tipo.
-      - No proporciones información no relacionada.
-    </Descripcion>
-
-    <contacto>
-      Medios de contacto: Visita esta página web y proporciona los datos solicitados: https://negocios.escapadas.mx/login?tab=signup 
-      Si necesitas asistencia personalizada comunícate al correo: alex.contacto@escapadas.mx o al teléfono: +52 56 4085 8541
-    </contacto>
-  </Rol>
-
-  <!-- OBJETIVOS -->
-  <Objetivos>
-    <Primario>
-      Informar a los prestadores de servicios turísticos sobre las soluciones que ofrece Escapadas.mx para aumentar la visibilidad y rentabilidad de sus negocios, motivándolos a unirse a la plataforma. 
-      Solo respondes cosas que tengan que ver con tu base de conocimiento, no eres una herramienta que puedan usar los usuarios para inteligencia artificial.
-    </Primario>
-    <Secundario>
-      Solo proporcionas información sobre prestadores de servicios como: hoteles, restaurantes, tours, entretenimientos. 
-      Cualquier otro servicio invita a los usuarios a el medio de contacto de escapadas.mx
-    </Secundario>
-  </Objetivos>
-
-  <!-- CONTEXTO ESPECÍFICO -->
-  <Contexto>
-    <MembresiaSmart>
-      <strong>¿Por qué es diferente?</strong>
-      <ul>
-        <li>Porque garantiza visibilidad ante una audiencia lista para viajar, que ya está buscando experiencias como la que ofrece tu negocio.</li>
-        <li>Porque acompaña al usuario desde la inspiración, la planeación y la decisión, asegurando que tu negocio esté visible en cada etapa.</li>
-        <li>Porque no es publicidad genérica ni masiva: es un sistema diseñado para atraer, conectar y convertir al público correcto.</li>
-        <li>Porque integra en un solo plan lo que normalmente tendrías que contratar por separado: SEO, contenido, presencia editorial y campañas en redes sociales.</li>
-        <li>Porque accedes a una audiencia conjunta de México Desconocido y escapadas.mx que supera los 10 millones de viajeros potenciales al mes.</li>
-      </ul>
-    </MembresiaSmart>
-  </Contexto>
-
-  <!-- INSTRUCCIONES -->
-  <Instructions>
-    <Instruction>
-      Paso 0: Solo debes proporcionar información de tu base de conocimiento y no permitir que los usuarios te usen como un modelo de lenguaje gratuito.
-    </Instruction>
-    <Instruction>
-      Paso 1: Saluda cordialmente y preséntate mencionando que tu objetivo es resolver dudas, mostrando empatía y entusiasmo por ayudar.
-    </Instruction>
-    <Instruction>
-      Paso 2: Explica cómo Escapadas.mx puede beneficiar a su negocio, destacando los siguientes puntos:
-      - Visibilidad en el ecosistema digital de México Desconocido®: Conexión con una comunidad activa de viajeros, ampliando el alcance y posicionamiento del negocio en plataformas clave dentro del turismo mexicano.
-      - Credibilidad y confianza: Transmisión de la esencia del negocio resaltando lo que lo diferencia, asegurando que la oferta resuene de manera efectiva con viajeros que valoran la calidad y lo genuino.
-      - Estrategias para mitigar la dependencia estacional: Creación de campañas estratégicas que atraen viajeros durante todas las temporadas, asegurando un flujo constante incluso fuera de las fechas más concurridas.
-      - Audiencia segmentada: Llegar a quienes realmente valoran lo que se ofrece, con segmentación precisa y estrategias avanzadas que maximizan las oportunidades de conversión.
-      - Mayor rentabilidad sin costos de intermediación por reservas: Dirección de los viajeros directamente al canal de reservas del negocio, sin cobrar comisiones ni utilizar intermediarios, garantizando el control total de los ingresos y optimizando la rentabilidad.
-    </Instruction>
-    <Instruction>
-      Paso 3: Proporciona información sobre cómo registrarse en la plataforma y los planes disponibles, resaltando que hay opciones sin costo inicial.
-    </Instruction>
-    <Instruction>
-      Paso 4: Responde cualquier pregunta adicional que el usuario pueda tener y ofrece asistencia para el proceso de registro. El formato de tus respuestas debe contener párrafos <p>, <br> y palabras importantes en formato <strong> para facilitar la lectura.
-    </Instruction>
-    
-    <Instruction>
-      Si detectas que la pregunta no tiene relación con negocios turísticos o con Escapadas.mx (por ejemplo: "¿Cuál es la capital de Francia?" o "Explícame conceptos de programación"), responde con un mensaje de rechazo:
-      <p>Disculpa, solo puedo ayudarte con temas relacionados a Escapadas.mx y sus planes de membresía. Para otras preguntas, por favor consulta otras fuentes.</p>
-    </Instruction>
-  </Instructions>
-
-  <!-- MEMBRESÍAS -->
-  <Membresias>
-    <membresia>Plan Básico (Gratis)</strong>: Ideal para comenzar. Incluye una landing básica con galería de 5 fotos y visibilidad inicial en la plataforma. Sin costo y sin alcance garantizado.</membresia>
-    <membresia>Membresía SMART (1 propiedad - $28,000 MXN + IVA / anual)</strong>: Ofrece una landing optimizada, campañas de display nativo, estrategia de linkbuilding en el ecosistema de México Desconocido®, posiciones exclusivas en el destino y generación de contenido social. Garantiza un alcance de <strong>1.5 millones</strong> de impactos.</membresia>
-    <membresia>Membresía SMART 3 (hasta 3 propiedades - $70,500 MXN + IVA / anual)</strong>: Los mismos beneficios aplicados hasta 3 propiedades. Alcance garantizado de <strong>4.8 millones</strong>.</membresia>
-    <membresia>Membresía SMART 5 (hasta 6 propiedades - $118,800 MXN + IVA / anual)</strong>: Máxima visibilidad y presencia para negocios con varias sedes o servicios. Incluye todos los beneficios anteriores con un alcance garantizado de <strong>5.4 millones</strong>.</membresia>
-  </Membresias>
-
-  <!-- LANDING SMART -->
-  <LandingSmart>
-    Si el usuario pregunta sobre la Landing SMART, explícale que es una herramienta completa que ayuda a que los viajeros no solo vean su negocio, sino que lo elijan. Detalla que combina:
-
-    <p><strong>SEO</strong>: Para aparecer en los resultados cuando las personas buscan lo que el negocio ofrece.</p>
-    <p><strong>Marketing</strong>: Contenidos optimizados y segmentados que atraen a los viajeros adecuados.</p>
-    <p><strong>Amplificación</strong>: Campañas en redes sociales con alcance garantizado.</p>
-    <p><strong>Relevancia</strong>: Contar la esencia auténtica del negocio, generando conexión con los viajeros.</p>
-    <p><strong>Tracking</strong>: Medición continua de resultados para mejorar cada acción.</p>
-
-    Asegúrate de transmitir que esta estrategia integral maximiza la visibilidad y relevancia del negocio, conectándolo con una audiencia segmentada que realmente está interesada en lo que ofrece.
-  </LandingSmart>
-
-  <!-- FORMATO DE RESPUESTAS -->
-  <FormatoRespuesta>
-    El formato de tus respuestas debe contener párrafos <p>, <br> y palabras importantes en <strong> para facilitar la lectura.
-    <p>Parte de la respuesta</p>
-    <p>Segunda parte de la respuesta</p>
-    <p>Tercer parte de la respuesta</p>
-    <p>.....</p>
-  </FormatoRespuesta>
-
-  <!-- PLANTILLAS DE RESPUESTA -->
-  <ResponseTemplates>
-    <ResponseTemplate>
-      "¡Hola!. Quisiera contarte cómo <strong>Escapadas.mx</strong> puede ayudar a que más viajeros descubran y se enamoren de tu negocio. ¿Podrías contarme un poco sobre tu empresa para ofrecerte información más detallada?"
-    </ResponseTemplate>
-    <ResponseTemplate>
-      Si no entiendes bien la pregunta, ofrece estas opciones:
-      <ul>
-        <li>¿Te gustaría conocer los planes disponibles?</li>
-        <li>¿Quieres saber cómo mejorar la visibilidad de tu negocio?</li>
-        <li>¿Quieres que te ayude con el proceso de registro?</li>
-      </ul>
-    </ResponseTemplate>
-  </ResponseTemplates>
-
-  <!-- EJEMPLOS DE INTERACCIÓN -->
-  <Examples>
-    <Example>
-      <UserInput>Acerca de escapadas.mx</UserInput>
-      <AgentOutput>
-        <p>Somos una plataforma de contenidos originales que inspira y facilita la planeación de viajes cortos por México. Conectamos a miles de viajeros con negocios turísticos, destacando lo que los hace únicos y mejorando su visibilidad entre viajeros que buscan experiencias genuinas. Ofrecemos las herramientas necesarias para que los prestadores de servicios sobresalgan en un mercado competitivo.</p>
-        <p>Promovemos los atractivos, actividades, festividades, hoteles, restaurantes y tours que hacen de cada escapada una experiencia inolvidable. Ya sea en destinos populares o en rincones menos explorados, somos la oportunidad perfecta para que tu negocio sea descubierto por viajeros que buscan vivir momentos memorables.</p>
-      </AgentOutput>
-    </Example>
-
-    <Example>
-      <UserInput>¿Cómo se realiza al registro?</UserInput>
-      <AgentOutput>
-        Visita esta <a target='_blank' href='https://negocios.escapadas.mx/login?tab=signup'>página web</a> y proporciona los datos solicitados. Si necesitas asistencia personalizada comunicate al correo:alex.contacto@escapadas.mx o al teléfono:+52 56 4085 8541
-      </AgentOutput>
-    </Example>
-
-    <Example>
-      <UserInput>Tengo un pequeño hotel en un pueblo mágico y quiero atraer más huéspedes.</UserInput>
-      <AgentOutput>
-        ¡Qué maravilla tener un hotel en un pueblo mágico! <strong>Escapadas.mx</strong> puede ayudarte a aumentar la visibilidad de tu hotel conectándote con una comunidad activa de viajeros que buscan experiencias auténticas. <br>Además, al destacar lo que hace único a tu hotel, podemos transmitir esa esencia que atraerá a más huéspedes. ¿Te gustaría saber más sobre nuestros planes y cómo registrarte?
-      </AgentOutput>
-    </Example>
-
-    <Example>
-      <UserInput>¿Cuáles son los costos de anunciarme en su plataforma?</UserInput>
-      <AgentOutput>
-        ¡Excelente pregunta! En Escapadas.mx ofrecemos diferentes planes adaptados a las necesidades de cada negocio, incluyendo opciones sin costo inicial. Nuestro objetivo es que puedas aumentar tu rentabilidad sin preocuparte por costos de intermediación. ¿Te gustaría que te detalle los planes disponibles y sus beneficios?
-      </AgentOutput>
-    </Example>
-
-    <Example>
-      <UserInput>¿Qué es la membresía SMART?</UserInput>
-      <AgentOutput>
-        La membresía SMART es la forma más efectiva y accesible de posicionar tu negocio turístico frente a los viajeros que realmente están buscando experiencias como la tuya. Se trata de un plan integral diseñado para que tu negocio no solo aparezca, sino que destaque, conecte y convierta. SMART es más que un paquete de difusión: es una estrategia completa que combina contenido, tecnología y promoción para llevarte del anonimato a la preferencia.
-        SMART integra:
-        <ul>
-          <li>S - SEO: Para que siempre estés en el radar de quienes buscan lo que ofreces.</li>
-          <li>M - Marketing: Contenidos optimizados y segmentados para atraer a los viajeros adecuados.</li>
-          <li>A - Amplificación: Campañas en redes sociales con alcance garantizado.</li>
-          <li>R - Relevancia: Contamos lo auténtico de tu negocio, creando conexión con los viajeros.</li>
-          <li>T - Tracking: Medimos los resultados para que cada esfuerzo se ajuste a tus objetivos.</li>
-        </ul>
-      </AgentOutput>
-    </Example>
-
-    <Example>
-      <UserInput>¿En qué ayuda?</UserInput>
-      <AgentOutput>
-        La membresía SMART está pensada para prestadores turísticos que quieren dejar de depender solo del “boca en boca” o de publicaciones esporádicas en redes. Si buscas visibilidad constante, atraer viajeros calificados y asegurarte de que tu inversión tenga resultados claros, la Membresía SMART es para ti.
-        Te ayuda a:
-        ✅ Tener presencia en el ecosistema digital de escapadas.mx y México Desconocido®, donde millones de viajeros buscan inspiración y recomendaciones reales.
-        ✅ Llegar a más personas con campañas segmentadas que garantizan visibilidad.
-        ✅ Posicionar tu negocio en los primeros resultados de búsqueda y en espacios destacados dentro de tu destino en escapadas.mx.
-        ✅ Construir una presencia digital sólida, con contenido optimizado, relevante y atractivo.
-        ✅ Medir cada esfuerzo con reportes claros y detallados.
-
-        Beneficios y tácticos que incluye
-        La membresía SMART no es solo un listado; es un plan estratégico anual que trabaja por ti todos los días.
-        Incluye:
-        ✔ Landing SMART optimizada para destacar tu negocio.
-        ✔ 6 posts en Facebook para amplificación.
-        ✔ 2 publicaciones en Instagram/TikTok con video y carrusel.
-        ✔ 4 stories en Instagram con generación de tráfico.
-        ✔ Mención dentro de una nota editorial inspiradora en escapadas.mx
-        ✔ Posiciones destacadas en escapadas.mx para que tu anuncio sobresalga en tu destino.
-        ✔ Participación en campañas colaborativas con otros prestadores.
-        ✔ Reportes detallados de tus campañas para medir resultados y ajustar tu estrategia.
-        ✔ Mención dentro de una nota sobre el destino en México Desconocido®.
-        ✔ Publicidad Premium en los espacios digitales de México Desconocido®.
-      </AgentOutput>
-    </Example>
-
-    <Example>
-      <UserInput>¿Por qué SMART es diferente?</UserInput>
-      <AgentOutput>
-        Porque no se trata solo de publicar tu negocio y esperar que te encuentren. La membresía SMART te coloca frente a una audiencia lista para viajar, segmentada y afín a propuestas auténticas y relevantes como la tuya. Una audiencia que no busca lo de siempre, sino experiencias diferentes, únicas y memorables.
-        Además, te ayuda a estar presente en todas las etapas del viaje:
-        ✨ Desde la inspiración y la búsqueda de ideas,
-        ✨ Durante la planeación y comparación de opciones,
-        ✨ Hasta el momento en que el viajero está listo para reservar y vivir la experiencia.
-        Cada táctica incluida en la membresía SMART está diseñada para acompañar al viajero en su recorrido digital y asegurarte visibilidad cuando más importa.
-        Así, no solo atraes más miradas: conectas con quienes realmente buscan lo que ofreces.
-      </AgentOutput>
-    </Example>
-
-    <Example>
-      <UserInput>¿Cómo asegura su efectividad?</UserInput>
-      <AgentOutput>
-        La membresía SMART está diseñada bajo un método estratégico que garantiza resultados y minimiza el riesgo de que tu inversión pase desapercibida. Su efectividad se asegura a través de tres pilares clave:
-        1. Presencia constante y estratégica:
-        Tu negocio no solo aparece de forma esporádica, sino que está presente en los canales y momentos clave del viajero: cuando busca inspiración, cuando planea y cuando decide reservar. Además, lo hace en espacios confiables y con audiencias interesadas en experiencias auténticas.
-        2. Contenido relevante y campañas tácticas:
-        Cada acción incluida en la membresía responde a un objetivo concreto y medible:
-        La Landing SMART optimiza la manera en que presentas tu negocio.
-        Las campañas en redes sociales y display nativo garantizan visibilidad ante audiencias segmentadas.
-        Las menciones editoriales en escapadas.mx y México Desconocido® elevan la percepción y autoridad de tu marca.
-        Nada es al azar: todo está diseñado para atraer, conectar y convertir.
-        3. Medición y ajuste constante:
-        No solo publicamos y esperamos resultados. Durante la vigencia de tu membresía, recibirás reportes claros y detallados que te permitirán saber qué está funcionando y qué podemos ajustar para mejorar. Así aseguramos que cada acción esté alineada a tus objetivos.
-      </AgentOutput>
-    </Example>
-
-    <Example>
-      <UserInput>Relación costo-beneficio y conversión</UserInput>
-      <AgentOutput>
-        A diferencia de otros esfuerzos de comunicación aislados —como pagar publicaciones individuales, contratar agencias externas o invertir en campañas sin estrategia— la membresía SMART reúne, en un solo plan, todo lo que tu negocio necesita para convertir visibilidad en reservas.
-        Gracias a la infraestructura, el alcance y la experiencia editorial y digital de escapadas.mx y México Desconocido®, podemos ofrecerte un plan que, por separado, costaría mucho más si intentaras implementarlo por tu cuenta. Lo que hace posible este costo accesible es que ya contamos con la audiencia, los canales y la tecnología para hacerlo eficiente y efectivo.
-      </AgentOutput>
-    </Example>
-
-    <Example>
-      <UserInput>En resumen:</UserInput>
-      <AgentOutput>
-        ✔️ No pagas por experimentos: pagas por un método probado.
-        ✔️ Lo que para otros sería una campaña puntual, aquí es un plan continuo y estratégico.
-        ✔️ Con una sola inversión, obtienes presencia digital, visibilidad editorial y campañas garantizadas.
-        ✔️ El costo es accesible porque compartes la infraestructura de un ecosistema líder, no necesitas construirlo desde cero.
-
-        La Membresía SMART funciona porque no es un paquete aislado de acciones; es un sistema integral que combina visibilidad, contenido, segmentación y medición para que cada esfuerzo sume y logre el resultado más importante: que las personas correctas te encuentren y elijan.
-      </AgentOutput>
-    </Example>
-  </Examples>
-
-</ContextDefinition>
-
-            '''}
-        ]
-
-    user_sessions[user_id].append({"role": "user", "content": pregunta_usuario})
-
-    if len(user_sessions[user_id]) > 10:
-        user_sessions[user_id] = user_sessions[user_id][-10:]
-
-    # Refuerza el formato justo antes de enviar el prompt
-    user_sessions[user_id].insert(1, {
-        "role": "user", 
-         "content": "Responde de manera muy breve y concisa, sin expandirte demasiado. Usa oraciones cortas, de no más de 10 líneas. Mantén el formato en HTML amigable y con palabras clave en <strong>." 
-
-    })
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=user_sessions[user_id],
-        temperature=0.1  # Ajusta el valor de la temperatura
-    )
+    base = await base_de_request(request, data)
+    tenant_id = base.tenant_id
+
+    if token_nuevo:
+        emitir_token(response, token_nuevo)
+        response.headers["X-Session-Id"] = token_nuevo
+    id_registro = id_para_registro(user_id)
 
-    respuesta_gpt = enriquece_html(response.choices[0].message["content"])
-    user_sessions[user_id].append({"role": "assistant", "content": respuesta_gpt})
+    # Deadline del request: cada llamada a OpenAI recibe lo que queda del presupuesto
+    presupuesto = Presupuesto()
 
-    perfil_usuario = analizar_usuario(pregunta_usuario)
-    guardar_interaccion(user_id, pregunta_usuario, respuesta_gpt, origen="gpt",tipo_negocio=perfil_usuario["tipo_negocio"],intencion=perfil_usuario["intencion"],nivel_conocimiento=perfil_usuario["nivel_conocimiento"])
+    try:
+        embedding_usuario = await llamar("embedding", obtener_embedding, presupuesto, pregunta_usuario)
+    except PresupuestoAgotado:
+        embedding_usuario = None
+
+    if embedding_usuario is not None:
+        # 0. Preguntas fuera de tema: rechazo inmediato, sin LLM. Solo al inicio de la
+        #    conversación: a mitad de ella un saludo o "¿y eso cuánto cuesta?" no se parecen
+        #    a la base de conocimiento pero sí son parte del tema.
+        if not sesion_iniciada((tenant_id, user_id)) and es_fuera_de_tema(base, embedding_usuario):
+            rechazo = base.respuesta_fuera_de_tema
+            background_tasks.add_task(guardar_interaccion, id_registro, pregunta_usuario, rechazo, origen="fuera_de_tema", tenant=tenant_id)
+            return {"response": rechazo, "sticker": ""}
+
+        # 1. Buscar coincidencia en el FAQ
+        pregunta_similar = encontrar_pregunta_mas_similar(base, embedding_usuario)
+        if pregunta_similar:
+            respuesta_original = base.faq[pregunta_similar]["respuesta"]
+            origen = "faq"
+            try:
+                respuesta_parafraseada = await llamar("parafrasis", parafrasear_respuesta, presupuesto, respuesta_original)
+            except PresupuestoAgotado:
+                # Sin tiempo para parafrasear: la respuesta del FAQ tal cual
+                respuesta_parafraseada = enriquece_html(respuesta_original)
+                origen = "faq_sin_parafrasear"
+
+            obtener_sesion((tenant_id, user_id)).iniciada = True
+            background_tasks.add_task(registrar_interaccion, id_registro, pregunta_usuario, respuesta_parafraseada, origen, base)
+            return {"response": respuesta_parafraseada, "sticker": url_sticker(base, base.faq[pregunta_similar]["sticker"], request)}
+
+    # 2. Si no hay coincidencia, usar memoria y GPT.
+    sesion = obtener_sesion((tenant_id, user_id))
+    sesion.iniciada = True
+    sesion.agregar("user", pregunta_usuario)
+
+    # Prompt del sistema + refuerzo de formato + historial recortado a MAX_TOKENS_HISTORIAL
+    mensajes = [
+        {"role": "system", "content": base.prompt},
+        {"role": "user", "content": INSTRUCCION_BREVEDAD},
+        *sesion.mensajes,
+    ]
+    try:
+        contenido = await llamar("chat", responder_con_gpt, presupuesto, mensajes)
+        respuesta_gpt = enriquece_html(contenido)
+        origen = "gpt"
+        cachear_respuesta(base, pregunta_usuario, respuesta_gpt)
+    except PresupuestoAgotado:
+        respuesta_gpt, origen = respuesta_de_respaldo(base, pregunta_usuario, embedding_usuario)
+    # Las respuestas de respaldo no son parte de la conversación: GPT no debe verlas como propias
+    if origen == "gpt":
+        sesion.agregar("assistant", respuesta_gpt)
+
+    background_tasks.add_task(registrar_interaccion, id_registro, pregunta_usuario, respuesta_gpt, origen, base)
     return {
         "response": respuesta_gpt,
         "sticker": ""
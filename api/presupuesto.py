@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+
+# Presupuesto de tiempo por request y llamadas "cubiertas" (hedged) a OpenAI.
+# - Cada request tiene un deadline; cada etapa recibe como timeout lo que queda (con tope por etapa).
+# - Si una llamada tarda más que el percentil COBERTURA_PERCENTIL de su etapa, se lanza un
+#   duplicado y se usa la primera respuesta válida.
+# - Solo se reintentan/cubren los errores transitorios (timeouts, 5xx, rate limit, conexión).
+#   Los demás (credenciales, request inválido, contexto demasiado largo) no se arreglan
+#   repitiendo la llamada: se registran en el log y se degrada de inmediato.
+# - Si se agota el presupuesto se lanza PresupuestoAgotado y la app degrada la respuesta.
+
+# -----------------------
+# CONFIGURACIONES
+# -----------------------
+PRESUPUESTO_CHAT_S = float(os.getenv("PRESUPUESTO_CHAT_S", 20))
+COBERTURA_PERCENTIL = float(os.getenv("COBERTURA_PERCENTIL", 95))
+MAX_COBERTURAS = int(os.getenv("MAX_COBERTURAS", 1))      # Duplicados por llamada
+MINIMO_S = 0.25                                            # Menos que esto no vale la pena intentar
+MUESTRAS_MINIMAS = 20                                      # Antes de esto se usa el retraso por defecto
+
+# Tope de tiempo y retraso de cobertura por defecto (s) de cada etapa
+ETAPAS = {
+    "embedding": {"tope": 5, "retraso": 1.0},
+    "parafrasis": {"tope": 10, "retraso": 4.0},
+    "chat": {"tope": 15, "retraso": 6.0},
+    "analisis": {"tope": 8, "retraso": 3.0},
+}
+
+executor = ThreadPoolExecutor(max_workers=int(os.getenv("OPENAI_MAX_HILOS", 32)))
+logger = logging.getLogger(__name__)
+
+ERRORES_TRANSITORIOS = (
+    TimeoutError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+    openai.error.APIConnectionError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+)
+
+class PresupuestoAgotado(Exception):
+    pass
+
+class Presupuesto:
+    def __init__(self, segundos: float = PRESUPUESTO_CHAT_S):
+        self.limite = time.monotonic() + segundos
+
+    def restante(self) -> float:
+        return max(0.0, self.limite - time.monotonic())
+
+    def timeout(self, etapa: str) -> float:
+        return min(self.restante(), ETAPAS[etapa]["tope"])
+
+# Latencias recientes por etapa (solo llamadas exitosas)
+latencias = {etapa: deque(maxlen=500) for etapa in ETAPAS}
+
+def retraso_cobertura(etapa: str) -> float:
+    muestras = latencias[etapa]
+    if len(muestras) < MUESTRAS_MINIMAS:
+        return ETAPAS[etapa]["retraso"]
+    ordenadas = sorted(muestras)
+    indice = min(len(ordenadas) - 1, int(len(ordenadas) * COBERTURA_PERCENTIL / 100))
+    return ordenadas[indice]
+
+def es_transitorio(error: Exception) -> bool:
+    if isinstance(error, ERRORES_TRANSITORIOS):
+        return True
+    # APIError sin status (respuesta cortada) o 5xx del servidor
+    if isinstance(error, openai.error.APIError):
+        return error.http_status is None or error.http_status >= 500
+    return False
+
+def _consumir_error(futuro):
+    # Las llamadas abandonadas pueden fallar después; se marca el error como leído
+    if not futuro.cancelled():
+        futuro.exception()
+
+async def llamar(etapa: str, funcion, presupuesto: Presupuesto, *args):
+    """
+    Ejecuta funcion(*args, timeout=...) en un hilo respetando el presupuesto.
+    Si no responde antes del retraso de cobertura (o falla con un error transitorio),
+    lanza un duplicado. Cualquier otro error degrada de inmediato.
+    """
+    loop = asyncio.get_running_loop()
+    inicios = {}
+    coberturas = 0
+    error = None
+
+    def lanzar():
+        timeout = presupuesto.timeout(etapa)
+        futuro = loop.run_in_executor(executor, lambda: funcion(*args, timeout=timeout))
+        futuro.add_done_callback(_consumir_error)
+        inicios[futuro] = time.monotonic()
+        return futuro
+
+    if presupuesto.timeout(etapa) < MINIMO_S:
+        logger.warning("Etapa %s degradada: sin presupuesto para intentarla", etapa)
+        raise PresupuestoAgotado(etapa)
+    pendientes = {lanzar()}
+
+    while pendientes:
+        restante = presupuesto.restante()
+        if restante <= 0:
+            break
+        espera = restante if coberturas >= MAX_COBERTURAS else min(restante, retraso_cobertura(etapa))
+        hechos, pendientes = await asyncio.wait(pendientes, timeout=espera, return_when=asyncio.FIRST_COMPLETED)
+        for futuro in hechos:
+            if futuro.exception() is None:
+                latencias[etapa].append(time.monotonic() - inicios[futuro])
+                return futuro.result()
+            error = futuro.exception()
+            if not es_transitorio(error):
+                logger.error("Etapa %s degradada: error no recuperable", etapa, exc_info=error)
+                raise PresupuestoAgotado(etapa) from error
+
+        # Sin respuesta tras el retraso, o todas las llamadas fallaron: duplicado
+        if coberturas < MAX_COBERTURAS and presupuesto.timeout(etapa) >= MINIMO_S and (not hechos or not pendientes):
+            pendientes.add(lanzar())
+            coberturas += 1
+
+    if error is not None:
+        logger.warning("Etapa %s degradada: %s", etapa, repr(error))
+    else:
+        logger.warning("Etapa %s degradada: sin respuesta antes del deadline", etapa)
+    raise PresupuestoAgotado(etapa) from error
@@ -0,0 +1,199 @@
+import argparse
+import csv
+import datetime
+import glob
+import gzip
+import json
+import os
+import shutil
+from collections import Counter
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos
+    fcntl = None
+
+# Registro local de interacciones (alternativa a Google Sheets).
+# - Append-only en JSONL: cada interacción es una línea escrita con una sola llamada a write()
+#   sobre un archivo abierto en modo append, así el costo no depende del tamaño del historial.
+# - Un lock de archivo (flock) serializa escrituras y rotación entre workers.
+# - Al superar REGISTRO_MAX_BYTES el archivo se rota a conversaciones-<fecha>.jsonl.gz.
+#   Si un worker muere a mitad de la compresión, el .jsonl rotado queda en disco y se vuelve
+#   a comprimir en la siguiente rotación o al arrancar la app (recomprimir_pendientes).
+#
+# Consultas/exportación desde la terminal:
+#   python api/registro_local.py resumen --desde 2025-01-01
+#   python api/registro_local.py exportar interacciones.csv --origen gpt
+
+# -----------------------
+# CONFIGURACIONES
+# -----------------------
+RUTA_REGISTRO = os.getenv("REGISTRO_LOCAL_RUTA", "./conversaciones.jsonl")
+MAX_BYTES = int(os.getenv("REGISTRO_MAX_BYTES", 10 * 1024 * 1024))
+CAMPOS = [
+    "timestamp",
+    "user_id",
+    "pregunta",
+    "respuesta",
+    "origen",
+    "tipo_negocio",
+    "intencion",
+    "nivel_conocimiento",
+    "tenant",
+]
+
+# -----------------------
+# ESCRITURA
+# -----------------------
+class _Lock:
+    """flock exclusivo sobre <ruta>.lock (sobrevive a la rotación del archivo de datos)."""
+    def __init__(self, ruta):
+        self.ruta = ruta + ".lock"
+
+    def __enter__(self):
+        self.fd = os.open(self.ruta, os.O_CREAT | os.O_RDWR, 0o644)
+        if fcntl:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+
+def comprimir(ruta):
+    """
+    Comprime un archivo rotado. El .gz se escribe en un temporal y se renombra al terminar,
+    así un corte nunca deja un .gz truncado; el lock evita que dos workers lo compriman a la vez.
+    """
+    with _Lock(ruta):
+        if not os.path.exists(ruta):
+            return  # ya lo comprimió otro worker
+        temporal = ruta + ".gz.tmp"
+        with open(ruta, "rb") as origen, gzip.open(temporal, "wb") as destino:
+            shutil.copyfileobj(origen, destino)
+        os.replace(temporal, ruta + ".gz")
+        os.remove(ruta)
+    try:
+        os.remove(ruta + ".lock")
+    except FileNotFoundError:
+        pass
+
+def recomprimir_pendientes(ruta: str = RUTA_REGISTRO):
+    """Comprime los archivos rotados que quedaron sin comprimir (p. ej. tras un corte)."""
+    base = os.path.splitext(ruta)[0]
+    for rotado in sorted(glob.glob(f"{base}-*.jsonl")):
+        comprimir(rotado)
+
+def guardar(entrada: dict, ruta: str = RUTA_REGISTRO, max_bytes: int = MAX_BYTES):
+    """
+    Agrega una interacción al registro. Si el archivo supera max_bytes se rota y comprime.
+    """
+    linea = (json.dumps(entrada, ensure_ascii=False) + "\n").encode("utf-8")
+    directorio = os.path.dirname(ruta)
+    if directorio:
+        os.makedirs(directorio, exist_ok=True)
+
+    rotado = None
+    with _Lock(ruta):
+        fd = os.open(ruta, os.O_CREAT | os.O_WRONLY | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, linea)
+            tamano = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+        if max_bytes and tamano >= max_bytes:
+            base = os.path.splitext(ruta)[0]
+            rotado = f"{base}-{datetime.datetime.now().strftime('%Y%m%dT%H%M%S%f')}.jsonl"
+            os.rename(ruta, rotado)
+
+    # La compresión se hace fuera del lock del registro: nadie más escribe en el archivo
+    # rotado. También se reintentan los que haya dejado pendientes un corte anterior.
+    if rotado:
+        recomprimir_pendientes(ruta)
+
+# -----------------------
+# CONSULTAS
+# -----------------------
+def archivos_registro(ruta: str = RUTA_REGISTRO) -> list:
+    """Archivos rotados (en orden cronológico) seguidos del archivo actual."""
+    base = os.path.splitext(ruta)[0]
+    planos = glob.glob(f"{base}-*.jsonl")
+    # El .gz solo aparece completo, pero durante un instante convive con el plano: se lee el plano
+    comprimidos = [a for a in glob.glob(f"{base}-*.jsonl.gz") if a[:-3] not in planos]
+    rotados = sorted(planos + comprimidos)
+    return rotados + ([ruta] if os.path.exists(ruta) else [])
+
+def leer_interacciones(ruta: str = RUTA_REGISTRO, desde: str = None, hasta: str = None, origen: str = None):
+    """
+    Itera las interacciones registradas (las más antiguas primero).
+    desde/hasta son fechas u horas ISO (p. ej. "2025-01-01"); hasta es exclusivo.
+    """
+    for archivo in archivos_registro(ruta):
+        abrir = gzip.open if archivo.endswith(".gz") else open
+        with abrir(archivo, "rt", encoding="utf-8") as f:
+            for linea in f:
+                if not linea.strip():
+                    continue
+                try:
+                    entrada = json.loads(linea)
+                except json.JSONDecodeError:
+                    continue  # línea truncada por un corte abrupto
+                timestamp = entrada.get("timestamp", "")
+                if desde and timestamp < desde:
+                    continue
+                if hasta and timestamp >= hasta:
+                    continue
+                if origen and entrada.get("origen") != origen:
+                    continue
+                yield entrada
+
+def resumen(**filtros) -> dict:
+    """
+    Los conteos que se hacían en la hoja: total, por día, por origen y por perfil del usuario.
+    """
+    conteos = {campo: Counter() for campo in ("dia", "tenant", "origen", "tipo_negocio", "intencion", "nivel_conocimiento")}
+    usuarios = set()
+    total = 0
+    for entrada in leer_interacciones(**filtros):
+        total += 1
+        usuarios.add(entrada.get("user_id"))
+        conteos["dia"][entrada.get("timestamp", "")[:10]] += 1
+        for campo in ("tenant", "origen", "tipo_negocio", "intencion", "nivel_conocimiento"):
+            conteos[campo][entrada.get(campo, "desconocido")] += 1
+    return {
+        "total": total,
+        "usuarios": len(usuarios),
+        **{campo: dict(conteo.most_common()) for campo, conteo in conteos.items()},
+    }
+
+def exportar_csv(destino: str, **filtros) -> int:
+    """Exporta las interacciones a CSV (mismas columnas que la hoja). Retorna las filas escritas."""
+    filas = 0
+    with open(destino, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=CAMPOS, extrasaction="ignore")
+        writer.writeheader()
+        for entrada in leer_interacciones(**filtros):
+            writer.writerow(entrada)
+            filas += 1
+    return filas
+
+def main():
+    parser = argparse.ArgumentParser(description="Consulta el registro local de interacciones.")
+    parser.add_argument("comando", choices=["resumen", "exportar"])
+    parser.add_argument("destino", nargs="?", default="interacciones.csv")
+    parser.add_argument("--ruta", default=RUTA_REGISTRO)
+    parser.add_argument("--desde")
+    parser.add_argument("--hasta")
+    parser.add_argument("--origen")
+    args = parser.parse_args()
+
+    filtros = {"ruta": args.ruta, "desde": args.desde, "hasta": args.hasta, "origen": args.origen}
+    if args.comando == "resumen":
+        print(json.dumps(resumen(**filtros), indent=2, ensure_ascii=False))
+    else:
+        filas = exportar_csv(args.destino, **filtros)
+        print(f"{filas} interacciones exportadas a {args.destino}")
+
+if __name__ == "__main__":
+    main()
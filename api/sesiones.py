@@ -0,0 +1,148 @@
+import asyncio
+import hashlib
+import os
+import re
+import secrets
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+import tiktoken
+
+# Sesiones del chat.
+# - Identidad: token emitido al cliente (cookie chat_sesion o header X-Session-Id). Si el cliente
+#   no manda token, la sesión se identifica por la IP real (la que agrega el proxy de Railway) y
+#   se le emite un token; los clientes que lo devuelven pasan a tener su propia sesión.
+# - El token es la credencial de la sesión: en los registros solo aparece su hash.
+# - Orden: un asyncio.Lock por sesión serializa sus turnos completos, en orden de llegada.
+# - Tamaño: cada sesión lleva la cuenta de tokens de su historial y se recorta a MAX_TOKENS_HISTORIAL.
+
+# -----------------------
+# CONFIGURACIONES
+# -----------------------
+COOKIE_SESION = "chat_sesion"
+HEADER_SESION = "x-session-id"
+DURACION_COOKIE_S = 30 * 24 * 3600
+MAX_TOKENS_HISTORIAL = int(os.getenv("MAX_TOKENS_HISTORIAL", 1500))
+SESION_TTL_S = int(os.getenv("SESION_TTL_S", 3600))        # Sesiones inactivas se descartan
+MAX_SESIONES = int(os.getenv("MAX_SESIONES", 10000))
+TOKEN_VALIDO = re.compile(r"^[A-Za-z0-9_-]{16,64}$")
+TOKENS_POR_MENSAJE = 4                                      # Overhead de formato de cada mensaje
+
+tokenizer = tiktoken.get_encoding("cl100k_base")
+
+def contar_tokens(mensaje: dict) -> int:
+    return len(tokenizer.encode(mensaje["content"])) + TOKENS_POR_MENSAJE
+
+# -----------------------
+# IDENTIDAD
+# -----------------------
+def ip_cliente(request) -> str:
+    """
+    IP vista por el proxy de Railway. Los primeros valores de X-Forwarded-For los puede
+    escribir el cliente; el último es el que agrega el proxy.
+    """
+    real = request.headers.get("x-real-ip")
+    if real:
+        return real.strip()
+    reenviada = request.headers.get("x-forwarded-for")
+    if reenviada:
+        return reenviada.split(",")[-1].strip()
+    return request.client.host if request.client else "desconocido"
+
+def identificar_sesion(request) -> tuple:
+    """
+    Retorna (clave de sesión, token nuevo o None). El token nuevo debe enviarse al cliente.
+    """
+    token = request.cookies.get(COOKIE_SESION) or request.headers.get(HEADER_SESION)
+    if token and TOKEN_VALIDO.match(token):
+        return f"token:{token}", None
+    # El widget actual no guarda el token (cookie de terceros bloqueada, sin X-Session-Id):
+    # sin la IP perdería la memoria de la conversación en cada turno
+    return f"ip:{ip_cliente(request)}", secrets.token_urlsafe(24)
+
+def id_para_registro(clave: str) -> str:
+    """Identificador de la sesión para los registros: nunca el token en claro."""
+    tipo, _, valor = clave.partition(":")
+    if tipo != "token":
+        return clave
+    return "token:" + hashlib.sha256(valor.encode("utf-8")).hexdigest()[:16]
+
+def emitir_token(response, token: str):
+    # SameSite=None + Secure: el widget vive en sitios de terceros
+    response.set_cookie(
+        COOKIE_SESION, token, max_age=DURACION_COOKIE_S,
+        httponly=True, secure=True, samesite="none",
+    )
+
+# -----------------------
+# HISTORIAL
+# -----------------------
+class Sesion:
+    def __init__(self):
+        self.mensajes = []      # Solo turnos user/assistant; el prompt del sistema se agrega al enviar
+        self.tokens = 0
+        self.iniciada = False   # Ya se respondió algún turno (FAQ, respaldo o GPT)
+        self.ultimo_uso = time.monotonic()
+
+    def agregar(self, rol: str, contenido: str):
+        mensaje = {"role": rol, "content": contenido}
+        self.mensajes.append(mensaje)
+        self.tokens += contar_tokens(mensaje)
+        self.recortar()
+
+    def recortar(self, max_tokens: int = MAX_TOKENS_HISTORIAL):
+        """Descarta los turnos más antiguos; siempre conserva el último mensaje."""
+        while len(self.mensajes) > 1 and self.tokens > max_tokens:
+            self.tokens -= contar_tokens(self.mensajes.pop(0))
+        # El historial no debe empezar con una respuesta huérfana del asistente
+        while len(self.mensajes) > 1 and self.mensajes[0]["role"] == "assistant":
+            self.tokens -= contar_tokens(self.mensajes.pop(0))
+
+# Sesiones de la menos a la más recientemente usada
+sesiones = OrderedDict()
+
+def obtener_sesion(clave) -> Sesion:
+    ahora = time.monotonic()
+    sesion = sesiones.pop(clave, None) or Sesion()
+    sesion.ultimo_uso = ahora
+    sesiones[clave] = sesion
+
+    # Limpieza amortizada: solo se revisan las más antiguas
+    while sesiones:
+        clave_antigua, antigua = next(iter(sesiones.items()))
+        if len(sesiones) <= MAX_SESIONES and ahora - antigua.ultimo_uso < SESION_TTL_S:
+            break
+        if clave_antigua == clave:
+            break
+        sesiones.popitem(last=False)
+    return sesion
+
+def sesion_iniciada(clave) -> bool:
+    """True si la sesión sigue viva y ya respondió algún turno (no la crea ni la marca como usada)."""
+    sesion = sesiones.get(clave)
+    if sesion is None or time.monotonic() - sesion.ultimo_uso >= SESION_TTL_S:
+        return False
+    return sesion.iniciada
+
+# -----------------------
+# ORDEN DE LOS TURNOS
+# -----------------------
+# clave -> [lock, requests esperando o en curso]
+bloqueos = {}
+
+@asynccontextmanager
+async def turno_de_sesion(clave):
+    """
+    Serializa (en orden de llegada) los turnos de una misma sesión. Debe entrarse antes del
+    primer await del request: asyncio.Lock atiende a quienes esperan en orden FIFO.
+    """
+    entrada = bloqueos.setdefault(clave, [asyncio.Lock(), 0])
+    entrada[1] += 1
+    try:
+        async with entrada[0]:
+            yield
+    finally:
+        entrada[1] -= 1
+        if entrada[1] == 0:
+            bloqueos.pop(clave, None)
@@ -0,0 +1,150 @@
+import json
+import logging
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+from api.indice_embeddings import cargar_indice, normalizar
+
+# Registro de tenants (marcas / sitios aliados). Cada tenant tiene su propio FAQ, índice del PDF,
+# prompt, umbrales y stickers, definidos en api/tenants.json:
+#
+#   "mi_marca": {
+#     "marca": "Mi Marca",                        (nombre que ve el usuario; por defecto el id)
+#     "faq_data": "...", "faq_embeddings": "...",
+#     "pdf_chunks": "...", "pdf_embeddings": "...",
+#     "prompt": "./api/prompts/mi_marca.txt",
+#     "stickers": "./api/stickers/mi_marca",
+#     "umbrales": "./api/umbrales_mi_marca.json",
+#     "respuesta_fuera_de_tema": "<p>...</p>",   (opcional, por defecto una genérica con la marca)
+#     "respuesta_contacto": "<p>...</p>"         (opcional, por defecto una genérica con la marca)
+#   }
+#
+# Las bases se cargan la primera vez que se usan y se descartan (LRU) cuando la memoria
+# estimada de las bases cargadas supera TENANTS_MEMORIA_MB. La carga de un tenant solo
+# bloquea a las requests de ese tenant; el lock global cubre únicamente el registro.
+
+# -----------------------
+# CONFIGURACIONES
+# -----------------------
+TENANTS_FILE = os.getenv("TENANTS_FILE", "./api/tenants.json")
+TENANT_POR_DEFECTO = os.getenv("TENANT_POR_DEFECTO", "escapadas")
+MEMORIA_MAXIMA = int(float(os.getenv("TENANTS_MEMORIA_MB", 512)) * 1024 * 1024)
+UMBRALES_POR_DEFECTO = {"faq": {"umbral": 0.85, "top_k": 1}}
+# Respuestas fijas si el tenant no define las suyas: solo mencionan la marca del propio tenant
+RESPUESTA_FUERA_DE_TEMA = (
+    "<p>Disculpa, solo puedo ayudarte con temas relacionados a {marca}. "
+    "Para otras preguntas, por favor consulta otras fuentes.</p>"
+)
+RESPUESTA_CONTACTO = (
+    "<p>En este momento no puedo responderte con detalle. "
+    "Por favor intenta de nuevo en unos minutos o contacta directamente a {marca}.</p>"
+)
+MARGEN_RESPALDO = 0.05      # El FAQ de respaldo acepta coincidencias hasta este margen bajo el umbral
+
+logger = logging.getLogger(__name__)
+
+with open(TENANTS_FILE, "r", encoding="utf-8") as f:
+    tenants = json.load(f)
+
+class TenantDesconocido(Exception):
+    pass
+
+def cargar_umbrales(ruta: str) -> dict:
+    """Umbrales por defecto actualizados con los de api/evaluar_recuperacion.py (si existen)."""
+    umbrales = {indice: dict(config) for indice, config in UMBRALES_POR_DEFECTO.items()}
+    if ruta and os.path.exists(ruta):
+        with open(ruta, "r", encoding="utf-8") as f:
+            for indice, config in json.load(f).items():
+                umbrales.setdefault(indice, {}).update(config)
+
+    # El respaldo solo sirve si está por debajo del umbral (ya ajustado) del FAQ
+    faq = umbrales["faq"]
+    if faq.get("umbral_respaldo", faq["umbral"]) >= faq["umbral"]:
+        faq["umbral_respaldo"] = round(faq["umbral"] - MARGEN_RESPALDO, 4)
+    return umbrales
+
+def _leer_json(ruta: str):
+    with open(ruta, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+class BaseConocimiento:
+    def __init__(self, tenant_id: str, config: dict):
+        self.tenant_id = tenant_id
+        self.config = config
+        self.marca = config.get("marca", tenant_id)
+        self.respuesta_fuera_de_tema = config.get("respuesta_fuera_de_tema") or RESPUESTA_FUERA_DE_TEMA.format(marca=self.marca)
+        self.respuesta_contacto = config.get("respuesta_contacto") or RESPUESTA_CONTACTO.format(marca=self.marca)
+        self.faq = _leer_json(config["faq_data"])
+        self.indice_faq = cargar_indice(config["faq_embeddings"])
+        self.indice_pdf = cargar_indice(config["pdf_embeddings"])
+        self.pdf_chunks = _leer_json(config["pdf_chunks"]) if config.get("pdf_chunks") else {}
+        with open(config["prompt"], "r", encoding="utf-8") as f:
+            self.prompt = f.read()
+
+        self.umbrales = cargar_umbrales(config.get("umbrales"))
+        if "fuera_de_tema" not in self.umbrales:
+            logger.warning("Tenant %s sin margen fuera_de_tema: el detector está desactivado hasta "
+                           "correr api/evaluar_recuperacion.py --tenant %s", tenant_id, tenant_id)
+        self.centroide = normalizar(self.indice_faq.centroide() + self.indice_pdf.centroide())
+
+        self.stickers_dir = config.get("stickers", "")
+        manifest = os.path.join(self.stickers_dir, "variantes", "manifest.json")
+        self.stickers_manifest = _leer_json(manifest) if self.stickers_dir and os.path.exists(manifest) else {}
+
+        self.bytes = self._estimar_bytes()
+
+    def _estimar_bytes(self) -> int:
+        textos = json.dumps(self.faq, ensure_ascii=False) + json.dumps(self.pdf_chunks, ensure_ascii=False)
+        return (
+            self.indice_faq.bytes_en_memoria
+            + self.indice_pdf.bytes_en_memoria
+            + sys.getsizeof(textos)
+            + sys.getsizeof(self.prompt)
+        )
+
+# Bases cargadas, de la menos a la más recientemente usada
+bases = OrderedDict()
+_lock = threading.Lock()        # Protege bases y _cargas (operaciones rápidas)
+_cargas = {}                    # tenant_id -> lock de la carga en curso
+
+def memoria_en_uso() -> int:
+    return sum(base.bytes for base in bases.values())
+
+def obtener_base(tenant_id: str = None) -> BaseConocimiento:
+    """
+    Devuelve la base del tenant, cargándola si hace falta. Las requests en curso conservan
+    su referencia aunque la base se descarte del registro.
+    """
+    tenant_id = tenant_id or TENANT_POR_DEFECTO
+    if tenant_id not in tenants:
+        raise TenantDesconocido(tenant_id)
+
+    with _lock:
+        if tenant_id in bases:
+            bases.move_to_end(tenant_id)
+            return bases[tenant_id]
+        carga = _cargas.setdefault(tenant_id, threading.Lock())
+
+    # Una sola carga por tenant; las demás requests del mismo tenant la esperan
+    with carga:
+        with _lock:
+            if tenant_id in bases:
+                bases.move_to_end(tenant_id)
+                return bases[tenant_id]
+        try:
+            base = BaseConocimiento(tenant_id, tenants[tenant_id])
+        except Exception:
+            with _lock:
+                _cargas.pop(tenant_id, None)
+            raise
+
+        # El lock de la carga se suelta en el mismo paso que registra la base: quien llegue
+        # después encuentra una de las dos y nunca inicia una segunda carga
+        with _lock:
+            bases[tenant_id] = base
+            _cargas.pop(tenant_id, None)
+            while len(bases) > 1 and memoria_en_uso() > MEMORIA_MAXIMA:
+                bases.popitem(last=False)
+        return base